@@ -0,0 +1,343 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import http.client
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+
+import webserver
+from webserver import TestWebServer
+
+TESTSET = 'bench'
+SERVER = 's1'
+DOMAIN = 'bench.test'
+
+# fixture class -> (scheme, path, extra request headers)
+FIXTURE_CLASSES = {
+    'small_html': ('http', '/small.html', {}),
+    'templated': ('http', '/templated.txt', {}),
+    'gzip': ('http', '/compressible.html', {'Accept-Encoding': 'gzip'}),
+    'mtu': ('http', '/mtu.html', {}),
+    'chunked': ('http', '/chunked.html', {}),
+    'index': ('http', '/listing/', {}),
+    'large_static': ('http', '/large.bin', {}),
+    'https': ('https', '/small.html', {}),
+}
+
+
+def write_fixture(path, content, **settings):
+    with open(path, 'wb') as f:
+        f.write(content)
+    for name, value in settings.items():
+        with open(path + '.' + name.replace('_', '-'), 'w') as f:
+            f.write(str(value))
+
+
+def create_fixtures(root, large_size):
+    server_path = os.path.join(root, TESTSET, SERVER)
+    os.makedirs(os.path.join(server_path, 'listing'))
+
+    paragraph = b'<p>The quick brown fox jumps over the lazy dog, again and again.</p>\n'
+    write_fixture(os.path.join(server_path, 'small.html'),
+                  b'<html><head><title>small</title></head><body>' + paragraph * 30 + b'</body></html>')
+    write_fixture(os.path.join(server_path, 'templated.txt'),
+                  b'Link to {SCHEME}://s2.bench.{DOMAIN}:{PORT}/page.html\n' * 200)
+    write_fixture(os.path.join(server_path, 'compressible.html'), paragraph * 500, content_encoding='negotiate')
+    write_fixture(os.path.join(server_path, 'mtu.html'), paragraph * 250, content_mtu=1460)
+    write_fixture(os.path.join(server_path, 'chunked.html'), paragraph * 500, chunked='random 1-4K 1',
+                  chunk_trailers='X-Checksum: bench')
+    write_fixture(os.path.join(server_path, 'large.bin'), os.urandom(large_size))
+    for i in range(1000):
+        write_fixture(os.path.join(server_path, 'listing', 'page%04d.html' % i), b'')
+
+
+def create_certificate(dir_path):
+    """Self signed certificate for the https class. Returns (keyfile, certfile), None if openssl isn't available"""
+    keyfile = os.path.join(dir_path, 'bench.key')
+    certfile = os.path.join(dir_path, 'bench.cert')
+    try:
+        subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-keyout', keyfile,
+                               '-out', certfile, '-days', '1', '-subj', '/CN=' + DOMAIN],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return keyfile, certfile
+
+
+class SniHTTPSConnection(http.client.HTTPSConnection):
+    """HTTPS connection to an address, sending server_name in the handshake"""
+
+    def __init__(self, address, port, server_name, context):
+        http.client.HTTPSConnection.__init__(self, address, port, context=context)
+        self.server_name = server_name
+
+    def connect(self):
+        http.client.HTTPConnection.connect(self)
+        self.sock = self._context.wrap_socket(self.sock, server_hostname=self.server_name)
+
+
+def connect(scheme, port, host):
+    if scheme == 'http':
+        return http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return SniHTTPSConnection('127.0.0.1', port, host, context)
+
+
+def run_client(scheme, port, host, path, headers, duration):
+    """Request path over a keep-alive connection until duration has passed.
+    Returns (latencies, errors, bytes received, elapsed seconds)"""
+    conn = None
+    latencies = []
+    errors = 0
+    received = 0
+    start = time.perf_counter()
+    deadline = start + duration
+    while time.perf_counter() < deadline:
+        if conn is None:
+            conn = connect(scheme, port, host)
+
+        request_start = time.perf_counter()
+        try:
+            conn.request('GET', path, headers=dict(headers, Host=host))
+            response = conn.getresponse()
+            received += len(response.read())
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            conn.close()
+            conn = None
+            continue
+
+        latencies.append(time.perf_counter() - request_start)
+        if response.status != 200:
+            errors += 1
+        if response.will_close:
+            conn.close()
+            conn = None
+
+    if conn is not None:
+        conn.close()
+    return latencies, errors, received, time.perf_counter() - start
+
+
+def percentile_ms(sorted_latencies, fraction):
+    if not sorted_latencies:
+        return None
+    return sorted_latencies[min(len(sorted_latencies) - 1, int(fraction * len(sorted_latencies)))] * 1000
+
+
+def process_rss(pid):
+    """Resident set size in bytes, None where /proc isn't available"""
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def server_rss(test_webserver):
+    sizes = [process_rss(os.getpid())] + [process_rss(worker.process.pid) for worker in test_webserver.workers]
+    if None in sizes:
+        return None
+    return sum(sizes)
+
+
+def run_class(pool, name, port, sslport, concurrency, duration):
+    scheme, path, headers = FIXTURE_CLASSES[name]
+    host = '%s.%s.%s' % (SERVER, TESTSET, DOMAIN)
+    client_port = port if scheme == 'http' else sslport
+
+    results = pool.starmap(run_client, [(scheme, client_port, host, path, headers, duration)] * concurrency)
+
+    latencies = sorted(latency for result in results for latency in result[0])
+    return {
+        'requests': len(latencies),
+        'errors': sum(result[1] for result in results),
+        'req_per_sec': sum(len(result[0]) / result[3] for result in results),
+        'bytes_per_sec': sum(result[2] / result[3] for result in results),
+        'p50_ms': percentile_ms(latencies, 0.50),
+        'p99_ms': percentile_ms(latencies, 0.99),
+        'p999_ms': percentile_ms(latencies, 0.999),
+    }
+
+
+def resolve_routes(resolver, duration):
+    """Resolve every fixture route in-process, with no sockets involved, until duration has passed, draining the
+    bodies. Connection resets and unbounded generated bodies are skipped, failures are exceptions and server
+    errors that aren't the fixture's status code.
+    Returns (resolutions, bytes, elapsed seconds, {url: failure})"""
+    requests = []
+    for (testset, server, path), route in sorted(resolver.routes.items()):
+        if route.kind == webserver.ROUTE_RESET or (route.generate is not None and route.generate.size is None):
+            continue
+        requests.append(('%s.%s.%s' % (server, testset, DOMAIN), urllib.parse.quote(path), route.status_code))
+
+    resolutions = 0
+    received = 0
+    failures = {}
+    start = time.perf_counter()
+    deadline = start + duration
+    while requests and time.perf_counter() < deadline:
+        for host, path, status_code in requests:
+            try:
+                response = resolver.resolve(host, path)
+                if response.sendfile is not None:
+                    received += response.sendfile[2]
+                else:
+                    received += sum(len(chunk) for chunk in response.body)
+                # server errors the fixture didn't ask for
+                if response.status >= 500 and response.status != status_code:
+                    failures[host + path] = 'status %d' % response.status
+            except Exception as e:
+                failures[host + path] = repr(e)
+        resolutions += len(requests)
+
+    return resolutions, received, time.perf_counter() - start, failures
+
+
+def git_version():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.realpath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(classes, engine, workers, concurrency, duration, port, sslport, keyfile, certfile, loggingconf, large_size,
+         output, pack=False):
+    fixture_dir = tempfile.mkdtemp(prefix='webserver-bench-')
+    try:
+        create_fixtures(fixture_dir, large_size)
+        if 'https' in classes and (keyfile is None or certfile is None):
+            certificate = create_certificate(fixture_dir)
+            if certificate is None:
+                print('openssl not available, skipping https', file=sys.stderr)
+                classes = [name for name in classes if name != 'https']
+            else:
+                keyfile, certfile = certificate
+
+        webserver.root_dir = fixture_dir
+        pack_path = None
+        if pack:
+            pack_path = os.path.join(fixture_dir, 'fixtures.pack')
+            webserver.pack_fixtures(fixture_dir, pack_path)
+
+        test_webserver = TestWebServer(port, sslport, keyfile, certfile, loggingconf, engine=engine,
+                                       workers=workers, pack=pack_path)
+        report = {'version': git_version(), 'python': platform.python_version(), 'engine': engine,
+                  'workers': workers, 'pack': pack, 'concurrency': concurrency, 'duration': duration,
+                  'started': int(time.time()), 'classes': {}}
+        try:
+            # clients run in their own processes, so they don't compete with the server for the GIL
+            with multiprocessing.get_context('spawn').Pool(concurrency) as pool:
+                for name in classes:
+                    print('Benchmarking', name, file=sys.stderr)
+                    result = run_class(pool, name, port, sslport, concurrency, duration)
+                    result['rss_bytes'] = server_rss(test_webserver)
+                    report['classes'][name] = result
+        finally:
+            test_webserver.stop()
+    finally:
+        shutil.rmtree(fixture_dir)
+
+    write_report(report, output)
+
+
+def main_in_process(testdir, duration, large_size, output, pack=False):
+    """Resolve the fixtures of testdir (the generated fixtures when None) without the server, reporting
+    resolutions per second and the routes that failed"""
+    fixture_dir = tempfile.mkdtemp(prefix='webserver-bench-')
+    try:
+        if testdir is None:
+            create_fixtures(fixture_dir, large_size)
+            testdir = fixture_dir
+
+        webserver.root_dir = testdir
+        pack_path = None
+        if pack:
+            pack_path = os.path.join(fixture_dir, 'fixtures.pack')
+            webserver.pack_fixtures(testdir, pack_path)
+
+        resolver = webserver.FixtureResolver(pack=pack_path)
+        resolutions, received, elapsed, failures = resolve_routes(resolver, duration)
+    finally:
+        shutil.rmtree(fixture_dir)
+
+    report = {'version': git_version(), 'python': platform.python_version(), 'in_process': True, 'pack': pack,
+              'duration': duration, 'started': int(time.time()), 'routes': len(resolver.routes),
+              'resolutions': resolutions, 'resolutions_per_sec': resolutions / elapsed,
+              'bytes_per_sec': received / elapsed, 'failures': failures}
+    write_report(report, output)
+
+
+def write_report(report, output):
+    if output is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Serve generated fixtures with TestWebServer and report throughput, '
+                                                 'latency and memory per fixture class as JSON')
+    parser.add_argument('--classes', dest='classes', default=','.join(FIXTURE_CLASSES), action='store',
+                        help='Comma separated fixture classes (default: {})'.format(','.join(FIXTURE_CLASSES)))
+    parser.add_argument('--engine', dest='engine', default=webserver.ENGINE_THREADED,
+                        choices=[webserver.ENGINE_THREADED, webserver.ENGINE_ASYNCIO],
+                        help='Webserver engine (default: threaded)')
+    parser.add_argument('--workers', dest='workers', type=int, default=1, action='store',
+                        help='Webserver worker processes (default: 1)')
+    parser.add_argument('--concurrency', dest='concurrency', type=int, default=8, action='store',
+                        help='Concurrent client connections (default: 8)')
+    parser.add_argument('--duration', dest='duration', type=float, default=5, action='store',
+                        help='Seconds each fixture class is benchmarked (default: 5)')
+    parser.add_argument('--port', dest='port', type=int, default=38080, action='store',
+                        help='HTTP port (default: 38080)')
+    parser.add_argument('--sslport', dest='sslport', type=int, default=38443, action='store',
+                        help='HTTPS port (default: 38443)')
+    parser.add_argument('--keyfile', dest='keyfile', action='store',
+                        help='SSL key file, a self signed certificate is created when not given')
+    parser.add_argument('--certfile', dest='certfile', action='store', help='SSL certificate file')
+    # per request DEBUG lines would be part of the measured latency, and logging.conf writes them to ./textlog
+    parser.add_argument('--loggingconf', dest='loggingconf', default='logging.quiet.conf', action='store',
+                        help='Webserver logging configuration (default: logging.quiet.conf, warnings only)')
+    parser.add_argument('--large-size', dest='large_size', type=int, default=16 * 1024 * 1024, action='store',
+                        help='Size in bytes of the large static fixture (default: 16MB)')
+    parser.add_argument('--output', dest='output', action='store', help='Write the JSON report to this file')
+    parser.add_argument('--pack', dest='pack', action='store_true',
+                        help='Serve the fixtures from a fixturepack archive instead of the directory')
+    parser.add_argument('--in-process', dest='in_process', action='store_true',
+                        help='Resolve every fixture route in-process without sockets instead of running the '
+                             'fixture classes against the server')
+    parser.add_argument('--testdir', dest='testdir', action='store',
+                        help='With --in-process, resolve the fixtures of this directory (eg. tests) instead of the '
+                             'generated ones')
+
+    args = parser.parse_args()
+    if args.in_process:
+        main_in_process(args.testdir, args.duration, args.large_size, args.output, args.pack)
+        sys.exit(0)
+
+    unknown = set(args.classes.split(',')) - set(FIXTURE_CLASSES)
+    if unknown:
+        parser.error('unknown fixture classes: ' + ', '.join(sorted(unknown)))
+    main(args.classes.split(','), args.engine, args.workers, args.concurrency, args.duration, args.port, args.sslport,
+         args.keyfile, args.certfile, args.loggingconf, args.large_size, args.output, args.pack)
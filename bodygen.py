@@ -0,0 +1,122 @@
+"""Synthetic response bodies described by .generate fixture recipes.
+
+A recipe is a single line in <file>.generate (or default-generate):
+    repeat <size> [<pattern>]    size bytes of pattern repeated (default pattern: A)
+    endless [<pattern>]          pattern repeated until the client disconnects
+    words <count> [<seed>]       count space separated words picked with a seeded random generator
+    gzip-bomb <inflated-size>    gzip stream of zeros inflating to inflated-size bytes
+
+Sizes accept K/M/G suffixes (eg. 450M). Bodies are produced lazily in chunks so memory use is
+independent of the body size.
+"""
+
+import random
+import zlib
+
+CHUNK_SIZE = 64 * 1024
+
+WORDS = ('banana', 'potato', 'apple', 'orange', 'carrot', 'tomato', 'cucumber', 'onion', 'garlic', 'pepper',
+         'lemon', 'cherry', 'grape', 'melon', 'peach', 'plum', 'pear', 'mango', 'kiwi', 'papaya', 'the', 'a', 'of',
+         'and', 'to', 'in', 'is', 'was', 'for', 'on', 'with', 'as', 'by', 'at', 'from', 'crawler', 'search', 'engine',
+         'index', 'document', 'spider', 'page', 'link', 'site', 'query', 'result', 'title', 'summary', 'word')
+
+SIZE_SUFFIXES = {'K': 1024, 'M': 1024 * 1024, 'G': 1024 * 1024 * 1024}
+
+
+def parse_size(value):
+    multiplier = SIZE_SUFFIXES.get(value[-1:].upper(), 1)
+    size = int(value[:-1] if multiplier != 1 else value) * multiplier
+    if size < 0:
+        raise ValueError('negative size: %s' % value)
+    return size
+
+
+class BodyRecipe:
+    """Parsed recipe. size is the body length or None when it isn't known up front"""
+
+    def __init__(self, kind, args, size):
+        self.kind = kind
+        self.args = args
+        self.size = size
+
+    def __repr__(self):
+        return 'BodyRecipe(%s %s)' % (self.kind, ' '.join(str(arg) for arg in self.args))
+
+    def content_encoding(self):
+        return 'gzip' if self.kind == 'gzip-bomb' else None
+
+    def chunks(self):
+        if self.kind == 'repeat':
+            return repeat_chunks(self.args[1], self.args[0])
+        if self.kind == 'endless':
+            return repeat_chunks(self.args[0], None)
+        if self.kind == 'words':
+            return word_chunks(self.args[0], self.args[1])
+        return gzip_bomb_chunks(self.args[0])
+
+
+def parse_recipe(text):
+    tokens = text.split()
+    if not tokens:
+        raise ValueError('empty body recipe')
+
+    kind = tokens[0]
+    if kind == 'repeat' and len(tokens) in (2, 3):
+        size = parse_size(tokens[1])
+        pattern = tokens[2].encode() if len(tokens) == 3 else b'A'
+        return BodyRecipe(kind, (size, pattern), size)
+    if kind == 'endless' and len(tokens) in (1, 2):
+        pattern = tokens[1].encode() if len(tokens) == 2 else b'A'
+        return BodyRecipe(kind, (pattern,), None)
+    if kind == 'words' and len(tokens) in (2, 3):
+        count = int(tokens[1])
+        if count < 0:
+            raise ValueError('negative word count: %s' % tokens[1])
+        seed = int(tokens[2]) if len(tokens) == 3 else 0
+        return BodyRecipe(kind, (count, seed), None)
+    if kind == 'gzip-bomb' and len(tokens) == 2:
+        return BodyRecipe(kind, (parse_size(tokens[1]),), None)
+
+    raise ValueError('invalid body recipe: %s' % text)
+
+
+def repeat_chunks(pattern, size):
+    block = pattern * max(1, CHUNK_SIZE // len(pattern))
+    if size is None:
+        while True:
+            yield block
+
+    while size > 0:
+        chunk = block[:size]
+        size -= len(chunk)
+        yield chunk
+
+
+def word_chunks(count, seed):
+    rnd = random.Random(seed)
+    words = []
+    length = 0
+    for i in range(count):
+        word = rnd.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+        if length >= CHUNK_SIZE:
+            yield (' '.join(words) + ' ').encode()
+            words = []
+            length = 0
+
+    if words:
+        yield ' '.join(words).encode()
+
+
+def gzip_bomb_chunks(inflated_size):
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 31)
+    zeros = bytes(CHUNK_SIZE)
+    while inflated_size > 0:
+        block = zeros[:inflated_size]
+        inflated_size -= len(block)
+        chunk = compressor.compress(block)
+        if chunk:
+            yield chunk
+
+    yield compressor.flush()
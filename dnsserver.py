@@ -0,0 +1,159 @@
+"""Authoritative DNS for the test hosts, so a crawler can resolve <server>.<testset>.<domain> without an
+external resolver.
+
+Queries for names in the zone are answered from a resolve callable: an A record for known hosts, NXDOMAIN
+for the others. Names outside the zone are refused. Only plain queries over UDP are handled, which is all a
+crawler's stub resolver sends.
+"""
+
+import asyncio
+import ipaddress
+import struct
+import threading
+
+HEADER = struct.Struct('!HHHHHH')
+QUESTION = struct.Struct('!HH')
+# answer to the single question, its name given as a pointer to the question at offset 12
+ANSWER_A = struct.Struct('!HHHIH4s')
+
+FLAG_RESPONSE = 0x8000
+FLAG_AUTHORITATIVE = 0x0400
+FLAG_RECURSION_DESIRED = 0x0100
+OPCODE_MASK = 0x7800
+
+RCODE_NOERROR = 0
+RCODE_FORMERR = 1
+RCODE_NXDOMAIN = 3
+RCODE_NOTIMP = 4
+RCODE_REFUSED = 5
+
+TYPE_A = 1
+TYPE_ANY = 255
+CLASS_IN = 1
+
+# seconds resolvers may cache an answer
+TTL = 60
+
+
+def parse_question(data):
+    """Return (id, flags, labels, qtype, qclass, end of the question) of a query"""
+    query_id, flags, qdcount = HEADER.unpack_from(data)[:3]
+    if flags & FLAG_RESPONSE or qdcount != 1:
+        raise ValueError('not a single question query')
+
+    labels = []
+    pos = HEADER.size
+    while data[pos]:
+        length = data[pos]
+        if length & 0xc0:
+            raise ValueError('compressed name in question')
+        labels.append(data[pos + 1:pos + 1 + length].decode('ascii').lower())
+        pos += 1 + length
+
+    qtype, qclass = QUESTION.unpack_from(data, pos + 1)
+    return query_id, flags, labels, qtype, qclass, pos + 1 + QUESTION.size
+
+
+class DnsProtocol(asyncio.DatagramProtocol):
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        response = self.server.respond(data)
+        if response is not None:
+            self.transport.sendto(response, addr)
+
+
+class DnsServer:
+    """UDP responder for zone on its own event loop thread. resolve(labels) gets the labels of a name in front of
+    the zone (eg. ('s1', 't1') for s1.t1.<zone>) and returns its IPv4 address, None if there's no such host"""
+
+    def __init__(self, server_address, zone, resolve):
+        self.server_address = server_address
+        self.zone = tuple(zone.lower().strip('.').split('.'))
+        self.resolve = resolve
+        self.queries = 0
+        self.answers = 0
+        self.nxdomain = 0
+        self.refused = 0
+        self.loop = asyncio.new_event_loop()
+        self._started = threading.Event()
+        self._stopped = threading.Event()
+        self._error = None
+        self.thread = threading.Thread(target=self.serve_forever, name="DnsServerThread", daemon=True)
+
+    def start(self):
+        """Start answering, raising OSError if the port can't be bound"""
+        self.thread.start()
+        self._started.wait()
+        if self._error is not None:
+            raise self._error
+
+    def serve_forever(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            transport, protocol = self.loop.run_until_complete(
+                self.loop.create_datagram_endpoint(lambda: DnsProtocol(self), local_addr=self.server_address))
+        except OSError as e:
+            self._error = e
+            self._started.set()
+            self.loop.close()
+            return
+
+        self._started.set()
+        try:
+            self.loop.run_forever()
+        finally:
+            transport.close()
+            self.loop.close()
+            self._stopped.set()
+
+    def shutdown(self):
+        if self._error is None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._stopped.wait()
+
+    def respond(self, data):
+        """Response to a query packet, None for packets not worth an answer"""
+        try:
+            query_id, flags, labels, qtype, qclass, end = parse_question(data)
+        except (ValueError, IndexError, struct.error, UnicodeDecodeError):
+            if len(data) < HEADER.size or data[2] & 0x80:
+                return None
+            return HEADER.pack(struct.unpack_from('!H', data)[0], FLAG_RESPONSE | RCODE_FORMERR, 0, 0, 0, 0)
+
+        self.queries += 1
+        question = data[HEADER.size:end]
+        flags = FLAG_RESPONSE | (flags & (OPCODE_MASK | FLAG_RECURSION_DESIRED))
+        if flags & OPCODE_MASK:
+            return HEADER.pack(query_id, flags | RCODE_NOTIMP, 1, 0, 0, 0) + question
+
+        zone_size = len(self.zone)
+        if tuple(labels[len(labels) - zone_size:]) != self.zone or qclass != CLASS_IN:
+            self.refused += 1
+            return HEADER.pack(query_id, flags | RCODE_REFUSED, 1, 0, 0, 0) + question
+
+        flags |= FLAG_AUTHORITATIVE
+        relative = tuple(labels[:len(labels) - zone_size])
+        address = None
+        if relative:
+            address = self.resolve(relative)
+            if address is None:
+                self.nxdomain += 1
+                return HEADER.pack(query_id, flags | RCODE_NXDOMAIN, 1, 0, 0, 0) + question
+
+        if address is None or qtype not in (TYPE_A, TYPE_ANY):
+            # the name exists, just without records of that type (eg. AAAA, or anything for the zone itself)
+            return HEADER.pack(query_id, flags | RCODE_NOERROR, 1, 0, 0, 0) + question
+
+        self.answers += 1
+        answer = ANSWER_A.pack(0xc000 | HEADER.size, TYPE_A, CLASS_IN, TTL, 4, ipaddress.IPv4Address(address).packed)
+        return HEADER.pack(query_id, flags | RCODE_NOERROR, 1, 1, 0, 0) + question + answer
+
+    def stats(self):
+        return {'queries': self.queries, 'answers': self.answers, 'nxdomain': self.nxdomain,
+                'refused': self.refused}
@@ -0,0 +1,91 @@
+"""Single file archive of a fixture tree, served by TestWebServer without touching the test directory.
+
+The directory tree stays the source of truth, the archive is compiled from it:
+    python fixturepack.py --testdir tests --output tests.pack
+and served with webserver.py --pack tests.pack. Rebuild the archive after editing fixtures.
+
+Layout:
+    header       MAGIC, then offset and length of the index (little endian uint64)
+    blobs        fixture bodies and the template literals that aren't a slice of their body
+    index        pickle of {'routes': RouteTable, 'files': {path: FileEntry}, 'listings': {dir: (mtime_ns, entries)}}
+
+Sidecars are resolved into the routes when the archive is built, so serving needs nothing but the index and
+slices of the mapped file. The index is a pickle, only serve archives you built yourself.
+"""
+
+import collections
+import mmap
+import os
+import pickle
+import struct
+
+MAGIC = b'WSPACK01'
+HEADER = struct.Struct('<8sQQ')
+
+# template is None for files served as they are, otherwise (charset, segments) with the literal segments
+# (even indices) as (offset, length) in the archive and the placeholder names at odd indices
+FileEntry = collections.namedtuple('FileEntry', ['offset', 'size', 'mtime_ns', 'template'])
+
+
+class PackWriter:
+    """Writes an archive next to path and moves it into place on close, so a server mapping the old archive
+    never sees it change underneath"""
+
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = path + '.tmp'
+        self.file = open(self.tmp_path, 'wb')
+        self.file.write(bytes(HEADER.size))
+        self.offset = HEADER.size
+
+    def add(self, data):
+        """Append a blob, returning its offset"""
+        offset = self.offset
+        self.file.write(data)
+        self.offset += len(data)
+        return offset
+
+    def close(self, index):
+        data = pickle.dumps(index, pickle.HIGHEST_PROTOCOL)
+        self.file.write(data)
+        self.file.seek(0)
+        self.file.write(HEADER.pack(MAGIC, self.offset, len(data)))
+        self.file.close()
+        os.replace(self.tmp_path, self.path)
+
+
+class FixturePack:
+    """Read only mapping of an archive"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, index_offset, index_size = HEADER.unpack_from(self.data)
+        if magic != MAGIC:
+            raise ValueError('%s is not a fixture archive' % path)
+
+        self.view = memoryview(self.data)
+        self.index = pickle.loads(self.view[index_offset:index_offset + index_size])
+
+    def blob(self, offset, size):
+        return self.view[offset:offset + size]
+
+
+if __name__ == '__main__':
+    import argparse
+
+    import webserver
+
+    parser = argparse.ArgumentParser(description='Compile a fixture directory into a single archive for '
+                                                 'webserver.py --pack')
+    parser.add_argument('--testdir', dest='testdir', default='tests', action='store',
+                        help='Directory containing test cases (default: tests)')
+    parser.add_argument('--output', dest='output', default='tests.pack', action='store',
+                        help='Archive to write (default: tests.pack)')
+
+    args = parser.parse_args()
+    files = webserver.pack_fixtures(args.testdir, args.output)
+    print('Packed %d files from %s into %s (%d bytes)' % (files, args.testdir, args.output,
+                                                         os.path.getsize(args.output)))
@@ -0,0 +1,121 @@
+"""Per-host crawler behaviour reconstructed from the requests TestWebServer served.
+
+For each test host (<server>.<testset>) the report has:
+    requests                number of requests
+    connections             number of connections that carried them
+    connection_concurrency  max and time weighted average of the connections open to the host at once
+    request_concurrency     the same for requests in flight
+    request_gaps            distribution of the seconds between the starts of consecutive requests
+    fetch_rate              requests started in each interval, counted from the start of the report
+
+Averages are taken over the time the host had at least one connection (or request) open, so a host fetched
+once a minute over a single connection averages 1, not close to 0.
+"""
+
+import bisect
+import collections
+import urllib.parse
+
+# upper bounds in seconds of the request gap histogram buckets, the last bucket counts everything slower
+GAP_BUCKETS = (0.001, 0.01, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60)
+# seconds per bucket of the fetch rate timeline
+TIMELINE_INTERVAL = 1.0
+
+
+def record_host(url):
+    """Return the <server>.<testset> host of a served url, None for hosts not in that form"""
+    labels = (urllib.parse.urlsplit(url).hostname or '').split('.')
+    if len(labels) < 2 or not labels[0] or not labels[1]:
+        return None
+    return labels[0] + '.' + labels[1]
+
+
+def concurrency(intervals):
+    """Return (max, time weighted average) of the number of overlapping (start, end) intervals, the average
+    taken over the time at least one of them is open. An interval ending when another starts doesn't overlap it"""
+    events = []
+    for start, end in intervals:
+        if end > start:
+            events.append((start, 1))
+            events.append((end, -1))
+    # at the same time, ends sort before starts
+    events.sort()
+
+    current = peak = 0
+    busy = weighted = 0.0
+    last = None
+    for timestamp, delta in events:
+        if current > 0:
+            busy += timestamp - last
+            weighted += current * (timestamp - last)
+        current += delta
+        peak = max(peak, current)
+        last = timestamp
+
+    return peak, weighted / busy if busy > 0 else 0.0
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def gap_distribution(starts):
+    """Distribution of the gaps between sorted request start times"""
+    gaps = sorted(b - a for a, b in zip(starts, starts[1:]))
+    histogram = [0] * (len(GAP_BUCKETS) + 1)
+    for gap in gaps:
+        histogram[bisect.bisect_left(GAP_BUCKETS, gap)] += 1
+
+    return {'count': len(gaps), 'min': gaps[0] if gaps else None, 'p50': percentile(gaps, 0.50),
+            'p90': percentile(gaps, 0.90), 'p99': percentile(gaps, 0.99), 'max': gaps[-1] if gaps else None,
+            'mean': sum(gaps) / len(gaps) if gaps else None, 'buckets': list(GAP_BUCKETS), 'histogram': histogram}
+
+
+def host_report(records, interval=TIMELINE_INTERVAL):
+    """Report on the crawler's behaviour per host from ServedRecords:
+        {'start': <first request>, 'interval': <seconds>, 'hosts': {<server>.<testset>: {...}, ...}}
+    Requests still in flight (no latency yet) only count towards requests, gaps and fetch rate"""
+    requests = collections.defaultdict(list)
+    # connection -> (time it closed, or its last request end while it's open)
+    connection_ends = {}
+    start = None
+    for record in records:
+        host = record_host(record.url)
+        if host is None:
+            continue
+
+        end = record.timestamp + record.latency if record.latency > 0 else None
+        requests[host].append((record.timestamp, end, record.connection))
+        start = record.timestamp if start is None else min(start, record.timestamp)
+
+        if record.connection is not None:
+            connection_end = record.connection_closed or end or record.timestamp
+            connection_ends[record.connection] = max(connection_ends.get(record.connection, 0), connection_end)
+
+    hosts = {}
+    for host, host_requests in requests.items():
+        host_requests.sort(key=lambda request: request[0])
+        starts = [request[0] for request in host_requests]
+        connections = {request[2] for request in host_requests if request[2] is not None}
+
+        max_connections, avg_connections = concurrency(
+            (connection[2], connection_ends[connection]) for connection in connections)
+        max_requests, avg_requests = concurrency(
+            (request_start, end) for request_start, end, connection in host_requests if end is not None)
+
+        fetch_rate = [0] * (int((starts[-1] - start) // interval) + 1)
+        for request_start in starts:
+            fetch_rate[int((request_start - start) // interval)] += 1
+
+        hosts[host] = {
+            'requests': len(host_requests),
+            'connections': len(connections),
+            'connection_concurrency': {'max': max_connections, 'avg': avg_connections},
+            'request_concurrency': {'max': max_requests, 'avg': avg_requests},
+            'request_gaps': gap_distribution(starts),
+            'fetch_rate': fetch_rate,
+        }
+
+    return {'start': start, 'interval': interval, 'hosts': hosts}
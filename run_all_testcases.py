@@ -4,7 +4,7 @@
 import os
 import re
 import subprocess
-from webserver import TestWebServer
+from webserver import TestWebServer, WebServerClient
 from testrunner import TestRunner
 from junit_xml import TestSuite
 from gigablast import GigablastInstances
@@ -16,13 +16,19 @@ def natural_sort(l):
     return sorted(l, key=alphanum_key)
 
 
-def main(testdir, gb_offset, gb_path, gb_num_instances, gb_num_shards, gb_host, gb_port, ws_scheme, ws_domain, ws_port):
+def main(testdir, gb_offset, gb_path, gb_num_instances, gb_num_shards, gb_host, gb_port, ws_scheme, ws_domain, ws_port,
+         dns_port=None, per_host_ips=False, shared_webserver=None):
     # prepare gigablast
     gb_instances = GigablastInstances(gb_offset, gb_path, gb_num_instances, gb_num_shards, gb_port)
 
-    # start webserver
-    ws_port += gb_offset
-    test_webserver = TestWebServer(ws_port)
+    # start webserver, or join a shared one as its own tenant
+    if shared_webserver is None:
+        ws_port += gb_offset
+        test_webserver = TestWebServer(ws_port, dns_port=dns_port, dns_domain=ws_domain, per_host_ips=per_host_ips)
+    else:
+        test_webserver = WebServerClient(shared_webserver, 'run%02d' % gb_offset)
+        ws_port = test_webserver.port
+        ws_domain = test_webserver.tenant + '.' + ws_domain
 
     # run testcases
     testcases = natural_sort(next(os.walk(args.testdir))[1])
@@ -30,6 +36,7 @@ def main(testdir, gb_offset, gb_path, gb_num_instances, gb_num_shards, gb_host,
     for testcase in testcases:
         print('Running testcase -', testcase)
         test_webserver.clear_served_urls()
+        test_webserver.reload_routes()
         test_runner = TestRunner(testdir, testcase, gb_instances, gb_host, test_webserver, ws_scheme, ws_domain, ws_port)
         results.append(test_runner.run_test())
 
@@ -68,6 +75,12 @@ if __name__ == '__main__':
                         help='Destination host domain (default: privacore.test)')
     parser.add_argument('--dest-port', dest='ws_port', type=int, default=28080, action='store',
                         help='Destination host port (default: 28080')
+    parser.add_argument('--dns-port', dest='dns_port', type=int, action='store',
+                        help='Answer DNS for the destination hosts on this port (gigablast queries 127.0.0.1:53)')
+    parser.add_argument('--per-host-ips', dest='per_host_ips', action='store_true',
+                        help='Resolve every destination host to its own 127.x.y.z address')
+    parser.add_argument('--webserver', dest='shared_webserver', action='store',
+                        help='Use a running webserver (host:port) shared with other runs instead of starting one')
 
     args = parser.parse_args()
-    main(args.testdir, args.gb_offset, args.gb_path, args.gb_num_instances, args.gb_num_shards, args.gb_host, args.gb_port, args.ws_scheme, args.ws_domain, args.ws_port)
+    main(args.testdir, args.gb_offset, args.gb_path, args.gb_num_instances, args.gb_num_shards, args.gb_host, args.gb_port, args.ws_scheme, args.ws_domain, args.ws_port, args.dns_port, args.per_host_ips, args.shared_webserver)
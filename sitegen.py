@@ -0,0 +1,133 @@
+"""Procedural virtual sites described by <server>.site spec files in a testset.
+
+A spec has one setting per line:
+    pages <count>          number of pages (sizes accept K/M/G suffixes, eg. 1M)
+    out-degree <count>     links per page
+    depth <levels>         every page is reachable from / within this many links
+    seed <number>          seed for the link graph, the same seed gives the same site
+    not-found <share>      share of links pointing to pages that don't exist (eg. 0.05)
+    redirects <share>      share of links going through a 301 redirect
+
+Page 0 is served at /, page n at /page/<n>.html, redirects at /moved/<n>.html and broken links at
+/missing/<n>-<i>.html. Pages are rendered on demand from the page number and the seed, so nothing is
+read from disk.
+"""
+
+import collections
+import random
+import re
+
+import bodygen
+
+SETTINGS = {'pages': bodygen.parse_size, 'out-degree': int, 'depth': int, 'seed': int, 'not-found': float,
+            'redirects': float}
+
+PATH_RE = re.compile(r'/(page|moved)/(0|[1-9][0-9]*)\.html')
+
+SitePage = collections.namedtuple('SitePage', ['status_code', 'location', 'content'])
+
+# words of body text on each page
+PAGE_WORDS = 50
+
+
+class SiteSpec:
+    """Parsed site spec. Pages are linked along a tree of the given depth, so all of them can be reached from
+    the root, with the remaining links of each page going to pseudo-random pages"""
+
+    def __init__(self, pages=1000, out_degree=10, depth=5, seed=0, not_found=0.0, redirects=0.0):
+        self.pages = pages
+        self.out_degree = out_degree
+        self.depth = depth
+        self.seed = seed
+        self.not_found = not_found
+        self.redirects = redirects
+        self.branching = tree_branching(pages, depth)
+
+    def __repr__(self):
+        return 'SiteSpec(pages=%d out-degree=%d depth=%d seed=%d)' % (self.pages, self.out_degree, self.depth,
+                                                                     self.seed)
+
+    def random(self, page):
+        return random.Random('%d:%d' % (self.seed, page))
+
+    def links(self, page, rnd=None):
+        """out_degree links of page: first to its children in the tree, then to pseudo-random pages"""
+        if rnd is None:
+            rnd = self.random(page)
+
+        children = range(page * self.branching + 1, min((page + 1) * self.branching + 1, self.pages))
+        links = []
+        for i in range(self.out_degree):
+            tree_link = i < len(children)
+            target = children[i] if tree_link else rnd.randrange(self.pages)
+
+            # links along the tree are never broken, they keep the whole site reachable
+            kind = rnd.random()
+            if kind < self.not_found and not tree_link:
+                links.append('/missing/%d-%d.html' % (page, i))
+            elif self.not_found <= kind < self.not_found + self.redirects:
+                links.append('/moved/%d.html' % target)
+            else:
+                links.append(page_url(target))
+
+        return links
+
+    def render(self, page):
+        rnd = self.random(page)
+        words = ' '.join(rnd.choice(bodygen.WORDS) for i in range(PAGE_WORDS))
+        content = ['<html>', '<head>', '<meta charset="UTF-8"/>', '	<title>Page %d</title>' % page, '</head>',
+                   '<body>', '<p>%s</p>' % words]
+        for link in self.links(page, rnd):
+            content.append('<p><a href="%s">%s</a></p>' % (link, link))
+        content.append('</body>')
+        content.append('</html>')
+        return ''.join(content).encode()
+
+    def resolve(self, path):
+        """Return the SitePage for path, None if there's no such page"""
+        if path == '/':
+            return SitePage(200, None, self.render(0))
+
+        match = PATH_RE.fullmatch(path)
+        if match is None or int(match.group(2)) >= self.pages:
+            return None
+
+        page = int(match.group(2))
+        if match.group(1) == 'moved':
+            return SitePage(301, page_url(page), b'')
+        return SitePage(200, None, self.render(page))
+
+
+def page_url(page):
+    return '/' if page == 0 else '/page/%d.html' % page
+
+
+def tree_branching(pages, depth):
+    """Smallest number of children per page that fits pages in a tree of the given depth"""
+    if depth < 1:
+        raise ValueError('invalid site depth: %d' % depth)
+
+    branching = 1
+    while sum(branching ** level for level in range(depth + 1)) < pages:
+        branching += 1
+    return branching
+
+
+def parse_spec(text):
+    settings = {}
+    for line in text.splitlines():
+        tokens = line.split()
+        if not tokens or tokens[0].startswith('#'):
+            continue
+        if len(tokens) != 2 or tokens[0] not in SETTINGS:
+            raise ValueError('invalid site setting: %s' % line)
+        settings[tokens[0].replace('-', '_')] = SETTINGS[tokens[0]](tokens[1])
+
+    # the defaults are valid, only the given settings need checking
+    if settings.get('pages', 1) < 1 or settings.get('depth', 1) < 1 or settings.get('out_degree', 0) < 0:
+        raise ValueError('invalid site spec: %s' % ' '.join(text.split()))
+
+    spec = SiteSpec(**settings)
+    if spec.pages > 1 and spec.branching > spec.out_degree:
+        raise ValueError('%s needs an out-degree of at least %d to reach every page' % (spec, spec.branching))
+    return spec
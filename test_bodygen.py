@@ -0,0 +1,20 @@
+#!/usr/bin/env python3
+import unittest
+
+import bodygen
+
+
+class ParseRecipeTest(unittest.TestCase):
+    def test_sizes(self):
+        self.assertEqual(bodygen.parse_recipe('repeat 0').size, 0)
+        self.assertEqual(bodygen.parse_recipe('repeat 2K xy').size, 2048)
+        self.assertEqual(b''.join(bodygen.parse_recipe('repeat 5 xy').chunks()), b'xyxyx')
+
+    def test_negative_sizes(self):
+        for recipe in ('repeat -5', 'repeat -1K', 'gzip-bomb -1M', 'words -3'):
+            with self.assertRaises(ValueError, msg=recipe):
+                bodygen.parse_recipe(recipe)
+
+
+if __name__ == '__main__':
+    unittest.main()
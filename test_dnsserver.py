@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+import struct
+import unittest
+
+import dnsserver
+from dnsserver import HEADER, QUESTION
+
+TYPE_AAAA = 28
+TYPE_MX = 15
+
+HOSTS = {('s1', 't1'): '127.1.0.1', ('s2', 't1'): '127.1.0.2'}
+
+
+def query(name, qtype=dnsserver.TYPE_A, qclass=dnsserver.CLASS_IN, query_id=0x1234,
+          flags=dnsserver.FLAG_RECURSION_DESIRED):
+    packet = HEADER.pack(query_id, flags, 1, 0, 0, 0)
+    for label in name.split('.'):
+        packet += bytes([len(label)]) + label.encode('ascii')
+    return packet + b'\0' + QUESTION.pack(qtype, qclass)
+
+
+def parse_response(data):
+    """Return (id, flags, rcode, question count, addresses of the A answers)"""
+    query_id, flags, qdcount, ancount = HEADER.unpack_from(data)[:4]
+    addresses = []
+    if ancount:
+        question_end = data.index(b'\0', HEADER.size) + 1 + QUESTION.size
+        for i in range(ancount):
+            answer = dnsserver.ANSWER_A.unpack_from(data, question_end + i * dnsserver.ANSWER_A.size)
+            addresses.append('.'.join(str(octet) for octet in answer[-1]))
+    return query_id, flags, flags & 0xf, qdcount, addresses
+
+
+class RespondTest(unittest.TestCase):
+    def setUp(self):
+        self.server = dnsserver.DnsServer(('127.0.0.1', 0), 'Privacore.Test.', lambda labels: HOSTS.get(labels))
+        self.addCleanup(self.server.loop.close)
+
+    def respond(self, data):
+        return parse_response(self.server.respond(data))
+
+    def test_a_answers(self):
+        for name, address in (('s1.t1.privacore.test', '127.1.0.1'), ('S2.T1.privacore.TEST', '127.1.0.2')):
+            query_id, flags, rcode, qdcount, addresses = self.respond(query(name))
+            self.assertEqual((query_id, rcode, qdcount, addresses), (0x1234, dnsserver.RCODE_NOERROR, 1, [address]))
+            self.assertTrue(flags & dnsserver.FLAG_RESPONSE)
+            self.assertTrue(flags & dnsserver.FLAG_AUTHORITATIVE)
+            self.assertTrue(flags & dnsserver.FLAG_RECURSION_DESIRED)
+
+        self.assertEqual(self.respond(query('s1.t1.privacore.test', dnsserver.TYPE_ANY))[2:],
+                         (dnsserver.RCODE_NOERROR, 1, ['127.1.0.1']))
+        self.assertEqual(self.server.stats()['answers'], 3)
+
+    def test_unsupported_type(self):
+        for qtype in (TYPE_AAAA, TYPE_MX):
+            self.assertEqual(self.respond(query('s1.t1.privacore.test', qtype))[2:], (dnsserver.RCODE_NOERROR, 1, []))
+        # the zone itself exists, without records
+        self.assertEqual(self.respond(query('privacore.test'))[2:], (dnsserver.RCODE_NOERROR, 1, []))
+
+    def test_unknown_name(self):
+        for name in ('s3.t1.privacore.test', 'www.s1.t1.privacore.test'):
+            query_id, flags, rcode, qdcount, addresses = self.respond(query(name))
+            self.assertEqual((rcode, addresses), (dnsserver.RCODE_NXDOMAIN, []), name)
+            self.assertTrue(flags & dnsserver.FLAG_AUTHORITATIVE)
+        self.assertEqual(self.server.stats()['nxdomain'], 2)
+
+    def test_outside_zone(self):
+        for data in (query('s1.t1.example.com'), query('test'), query('s1.t1.privacore.test', qclass=3)):
+            query_id, flags, rcode, qdcount, addresses = self.respond(data)
+            self.assertEqual((rcode, addresses), (dnsserver.RCODE_REFUSED, []))
+            self.assertFalse(flags & dnsserver.FLAG_AUTHORITATIVE)
+        self.assertEqual(self.server.stats()['refused'], 3)
+
+    def test_malformed_query(self):
+        truncated = query('s1.t1.privacore.test')[:-3]
+        two_questions = bytearray(query('s1.t1.privacore.test'))
+        two_questions[5] = 2
+        compressed = HEADER.pack(7, 0, 1, 0, 0, 0) + b'\xc0\x0c' + QUESTION.pack(1, 1)
+        for data in (truncated, bytes(two_questions), compressed, HEADER.pack(7, 0, 1, 0, 0, 0) + b'\x03\xff\xfe'):
+            query_id = struct.unpack_from('!H', data)[0]
+            self.assertEqual(self.respond(data), (query_id, dnsserver.FLAG_RESPONSE | dnsserver.RCODE_FORMERR,
+                                                  dnsserver.RCODE_FORMERR, 0, []))
+
+        # too short for a header, or a response, isn't answered at all
+        self.assertIsNone(self.server.respond(b'\x12\x34\x01'))
+        self.assertIsNone(self.server.respond(query('s1.t1.privacore.test', flags=dnsserver.FLAG_RESPONSE)))
+        self.assertEqual(self.server.stats()['queries'], 0)
+
+    def test_other_opcode(self):
+        self.assertEqual(self.respond(query('s1.t1.privacore.test', flags=0x2000))[2], dnsserver.RCODE_NOTIMP)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+import unittest
+
+import politeness
+from webserver import ServedRecord
+
+
+def record(url, timestamp, latency, connection=None, connection_closed=None):
+    return ServedRecord(url, timestamp, 200, 100, latency, '127.0.0.1', 0, connection, connection_closed)
+
+
+class ConcurrencyTest(unittest.TestCase):
+    def test_overlapping(self):
+        peak, average = politeness.concurrency([(0, 2), (1, 3)])
+        self.assertEqual(peak, 2)
+        self.assertAlmostEqual(average, 4 / 3)
+
+        peak, average = politeness.concurrency([(0, 10), (2, 4), (3, 5), (3, 4)])
+        self.assertEqual(peak, 4)
+        self.assertAlmostEqual(average, (10 + 2 + 2 + 1) / 10)
+
+    def test_adjacent(self):
+        # an interval ending when the next one starts doesn't overlap it
+        self.assertEqual(politeness.concurrency([(1, 2), (0, 1), (2, 3)]), (1, 1.0))
+
+    def test_idle_time_not_averaged(self):
+        self.assertEqual(politeness.concurrency([(0, 1), (60, 61)]), (1, 1.0))
+
+    def test_empty(self):
+        self.assertEqual(politeness.concurrency([]), (0, 0.0))
+        self.assertEqual(politeness.concurrency([(5, 5)]), (0, 0.0))
+
+
+class GapDistributionTest(unittest.TestCase):
+    def test_gaps(self):
+        gaps = politeness.gap_distribution([0, 0.0005, 1.5005, 1.5105, 71.5105])
+        self.assertEqual(gaps['count'], 4)
+        self.assertAlmostEqual(gaps['min'], 0.0005)
+        self.assertAlmostEqual(gaps['max'], 70)
+        self.assertAlmostEqual(gaps['mean'], 71.5105 / 4)
+        self.assertAlmostEqual(gaps['p50'], 1.5)
+        self.assertEqual(len(gaps['histogram']), len(gaps['buckets']) + 1)
+        self.assertEqual(gaps['histogram'][0], 1)
+        self.assertEqual(gaps['histogram'][-1], 1)
+        self.assertEqual(sum(gaps['histogram']), 4)
+
+    def test_single_request(self):
+        gaps = politeness.gap_distribution([3.0])
+        self.assertEqual((gaps['count'], gaps['min'], gaps['p50'], gaps['mean']), (0, None, None, None))
+
+
+class HostReportTest(unittest.TestCase):
+    def test_report(self):
+        a = ('127.0.0.1', 5000, 10.0)
+        b = ('127.0.0.1', 5001, 10.5)
+        records = [
+            # out of order, and interleaved with another host
+            record('http://s1.t1.example.com/3', 14.0, 0.5, b, 16.0),
+            record('http://s1.t1.example.com/1', 10.0, 1.0, a),
+            record('http://s2.t1.example.com/1', 10.2, 0.1),
+            record('http://s1.t1.example.com/2', 10.5, 1.0, b),
+            # still in flight
+            record('http://s1.t1.example.com/4', 15.0, 0.0, a),
+            record('http://localhost/_stats', 9.0, 0.1),
+        ]
+        report = politeness.host_report(records, interval=2.0)
+        self.assertEqual(report['start'], 10.0)
+        self.assertEqual(sorted(report['hosts']), ['s1.t1', 's2.t1'])
+
+        host = report['hosts']['s1.t1']
+        self.assertEqual((host['requests'], host['connections']), (4, 2))
+        # connection a stays open until its last request started, b until it was closed
+        self.assertEqual(host['connection_concurrency']['max'], 2)
+        self.assertAlmostEqual(host['connection_concurrency']['avg'], (5.0 + 5.5) / 6.0)
+        self.assertEqual(host['request_concurrency']['max'], 2)
+        self.assertAlmostEqual(host['request_concurrency']['avg'], 2.5 / 2.0)
+        # gaps between the sorted starts 10, 10.5, 14, 15
+        self.assertEqual(host['request_gaps']['count'], 3)
+        self.assertAlmostEqual(host['request_gaps']['min'], 0.5)
+        self.assertAlmostEqual(host['request_gaps']['max'], 3.5)
+        self.assertEqual(host['fetch_rate'], [2, 0, 2])
+
+        host = report['hosts']['s2.t1']
+        self.assertEqual((host['requests'], host['connections'], host['fetch_rate']), (1, 0, [1]))
+        self.assertEqual(host['request_gaps']['count'], 0)
+
+    def test_record_host(self):
+        self.assertEqual(politeness.record_host('https://S1.T1.example.com:4443/x'), 's1.t1')
+        self.assertIsNone(politeness.record_host('http://localhost/'))
+        self.assertIsNone(politeness.record_host('http://.t1.example.com/'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+import unittest
+
+import sitegen
+
+
+def link_target(link):
+    page = sitegen.PATH_RE.fullmatch(link)
+    if link == '/':
+        return 0
+    return int(page.group(2)) if page is not None else None
+
+
+class SiteSpecTest(unittest.TestCase):
+    def test_invalid_specs(self):
+        for text in ('pages 1000\ndepth 0', 'depth -1', 'pages 0', 'out-degree -1', 'colour blue',
+                     'pages 1000\nout-degree 10\ndepth 2'):
+            with self.assertRaises(ValueError, msg=text):
+                sitegen.parse_spec(text)
+
+        with self.assertRaises(ValueError):
+            sitegen.tree_branching(1000, 0)
+
+    def test_out_degree(self):
+        spec = sitegen.parse_spec('pages 1000\nout-degree 40\ndepth 2')
+        self.assertEqual(spec.branching, 32)
+        for page in (0, 30, 999):
+            self.assertEqual(len(spec.links(page)), 40)
+
+        self.assertEqual(sitegen.parse_spec('pages 1\nout-degree 0').links(0), [])
+
+    def test_every_page_reachable(self):
+        spec = sitegen.parse_spec('pages 500\nout-degree 8\ndepth 4\nnot-found 0.2\nredirects 0.2\nseed 7')
+        seen = {0}
+        pending = [0]
+        while pending:
+            for link in spec.links(pending.pop()):
+                target = link_target(link)
+                if target is not None and target not in seen:
+                    seen.add(target)
+                    pending.append(target)
+        self.assertEqual(len(seen), 500)
+
+    def test_resolve(self):
+        spec = sitegen.parse_spec('pages 10\nseed 3')
+        self.assertEqual(spec.resolve('/'), spec.resolve('/'))
+        self.assertEqual(spec.resolve('/moved/4.html')[:2], (301, '/page/4.html'))
+        self.assertIsNone(spec.resolve('/page/10.html'))
+        self.assertIsNone(spec.resolve('/missing/1-2.html'))
+
+
+if __name__ == '__main__':
+    unittest.main()
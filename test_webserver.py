@@ -0,0 +1,443 @@
+#!/usr/bin/env python3
+import http.client
+import io
+import itertools
+import json
+import logging
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+import unittest.mock
+
+import test_dnsserver
+import webserver
+
+# stop() leaves the listening sockets open, so every webserver gets its own port
+PORTS = itertools.count(18180)
+
+
+def write_fixture(root, path, content):
+    path = os.path.join(root, path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(content)
+
+
+class FixtureTreeTestCase(unittest.TestCase):
+    """Serves a test directory built by the test case in place of tests/"""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.saved_root_dir = webserver.root_dir
+        webserver.root_dir = self.root
+        self.addCleanup(setattr, webserver, 'root_dir', self.saved_root_dir)
+
+    def start_webserver(self, **kwargs):
+        self.port = next(PORTS)
+        test_webserver = webserver.TestWebServer(self.port, loggingconf='logging.dev.conf', **kwargs)
+        self.addCleanup(test_webserver.stop)
+        return test_webserver
+
+
+class PlaceholderTest(unittest.TestCase):
+    def test_fill_placeholders(self):
+        self.assertEqual(webserver.fill_placeholders('Link: <{SCHEME}://{DOMAIN}:{PORT}/>', 'https', 'd.test', 443),
+                         'Link: <https://d.test:443/>')
+        # braces that aren't placeholders are header text like any other
+        self.assertEqual(webserver.fill_placeholders('X-Json: {"a": {DOMAIN}} }{ {PATH}', 'http', 'd.test', 80),
+                         'X-Json: {"a": d.test} }{ {PATH}')
+
+
+class RangeTest(unittest.TestCase):
+    def test_parse_range(self):
+        self.assertEqual(webserver.parse_range('bytes=0-9', 100), [(0, 10)])
+        self.assertEqual(webserver.parse_range('bytes=5-150', 100), [(5, 100)])
+        # suffix and open-ended ranges
+        self.assertEqual(webserver.parse_range('bytes=-10', 100), [(90, 100)])
+        self.assertEqual(webserver.parse_range('bytes=-200', 100), [(0, 100)])
+        self.assertEqual(webserver.parse_range('bytes=90-', 100), [(90, 100)])
+        self.assertEqual(webserver.parse_range(' Bytes = 0-0 , 99- ', 100), [(0, 1), (99, 100)])
+
+    def test_unsatisfiable_range(self):
+        self.assertEqual(webserver.parse_range('bytes=100-', 100), [])
+        self.assertEqual(webserver.parse_range('bytes=200-300', 100), [])
+        self.assertEqual(webserver.parse_range('bytes=-0', 100), [])
+        self.assertEqual(webserver.parse_range('bytes=-5', 0), [])
+        # the satisfiable ranges of a list are kept
+        self.assertEqual(webserver.parse_range('bytes=0-1,500-600', 100), [(0, 2)])
+
+    def test_invalid_range(self):
+        for value in ('bytes=9-5', 'items=0-1', 'bytes=a-b', 'bytes=-', 'bytes=', 'bytes=0-1,x', '0-1'):
+            self.assertIsNone(webserver.parse_range(value, 100), value)
+
+    def test_etag_matches(self):
+        self.assertTrue(webserver.etag_matches('"a"', '"a"'))
+        self.assertTrue(webserver.etag_matches('"b", "a"', '"a"'))
+        self.assertFalse(webserver.etag_matches('"b"', '"a"'))
+        self.assertTrue(webserver.etag_matches('*', '"a"'))
+        # weak comparison ignores the W/ prefix on either side, strong comparison never matches a weak tag
+        self.assertTrue(webserver.etag_matches('W/"a"', '"a"'))
+        self.assertTrue(webserver.etag_matches('"a"', 'W/"a"'))
+        self.assertTrue(webserver.etag_matches('"a"', '"a"', weak=False))
+        self.assertFalse(webserver.etag_matches('W/"a"', '"a"', weak=False))
+        self.assertFalse(webserver.etag_matches('W/"a"', 'W/"a"', weak=False))
+
+
+class ConditionalRequestTest(FixtureTreeTestCase):
+    def setUp(self):
+        FixtureTreeTestCase.setUp(self)
+        self.content = bytes(range(100))
+        path = os.path.join(self.root, "t1/s1/r.bin")
+        os.makedirs(os.path.dirname(path))
+        with open(path, "wb") as f:
+            f.write(self.content)
+        self.resolver = webserver.FixtureResolver()
+
+        full = self.resolve()
+        self.etag = full.headers['ETag']
+        self.last_modified = full.headers['Last-Modified']
+
+    def resolve(self, **headers):
+        response = self.resolver.resolve('s1.t1.example.com', '/r.bin', headers)
+        if response.sendfile is not None:
+            path, offset, size = response.sendfile
+            with open(path, "rb") as f:
+                f.seek(offset)
+                body = f.read(size)
+        else:
+            body = b''.join(bytes(chunk) for chunk in response.body)
+        return response._replace(headers=webserver.request_headers(dict(response.headers)), body=body)
+
+    def test_full(self):
+        response = self.resolve()
+        self.assertEqual((response.status, response.body), (200, self.content))
+        self.assertEqual(response.headers['Accept-Ranges'], 'bytes')
+
+    def test_ranges(self):
+        for value, content_range, body in (('bytes=-10', 'bytes 90-99/100', self.content[90:]),
+                                           ('bytes=90-', 'bytes 90-99/100', self.content[90:]),
+                                           ('bytes=10-19', 'bytes 10-19/100', self.content[10:20])):
+            response = self.resolve(Range=value)
+            self.assertEqual((response.status, response.headers['Content-Range'], response.body),
+                             (206, content_range, body), value)
+            self.assertEqual(response.bytes_saved, 100 - len(body))
+
+        response = self.resolve(Range='bytes=100-')
+        self.assertEqual((response.status, response.headers['Content-Range']), (416, 'bytes */100'))
+
+        # an invalid header is ignored, the whole body is sent
+        response = self.resolve(Range='bytes=9-5')
+        self.assertEqual((response.status, response.body), (200, self.content))
+
+    def test_multiple_ranges(self):
+        response = self.resolve(Range='bytes=0-1,5-9')
+        self.assertEqual(response.status, 206)
+        content_type, _, boundary = response.headers['Content-Type'].partition('; boundary=')
+        self.assertEqual(content_type, 'multipart/byteranges')
+        self.assertEqual(int(response.headers['Content-Length']), len(response.body))
+
+        parts = response.body.split(b'\r\n--' + boundary.encode())
+        self.assertEqual(parts[0], b'')
+        self.assertEqual(parts[-1], b'--\r\n')
+        for part, (first, last) in zip(parts[1:-1], ((0, 1), (5, 9))):
+            head, _, body = part.partition(b'\r\n\r\n')
+            self.assertIn(b'Content-Range: bytes %d-%d/100' % (first, last), head)
+            self.assertEqual(body, self.content[first:last + 1])
+
+        # a list with a single satisfiable range falls back to a plain 206
+        response = self.resolve(Range='bytes=0-1,500-600')
+        self.assertEqual((response.status, response.headers['Content-Range'], response.body),
+                         (206, 'bytes 0-1/100', self.content[:2]))
+
+    def test_if_none_match(self):
+        for value in (self.etag, 'W/' + self.etag, '"other", ' + self.etag, '*'):
+            response = self.resolve(**{'If-None-Match': value})
+            self.assertEqual((response.status, response.body), (304, b''), value)
+            self.assertEqual(response.bytes_saved, 100)
+
+        self.assertEqual(self.resolve(**{'If-None-Match': '"other"'}).status, 200)
+        # If-Modified-Since doesn't count when If-None-Match is sent
+        self.assertEqual(self.resolve(**{'If-None-Match': '"other"', 'If-Modified-Since': self.last_modified}).status,
+                         200)
+
+    def test_if_modified_since(self):
+        self.assertEqual(self.resolve(**{'If-Modified-Since': self.last_modified}).status, 304)
+        self.assertEqual(self.resolve(**{'If-Modified-Since': 'Mon, 01 Jan 2001 00:00:00 GMT'}).status, 200)
+        self.assertEqual(self.resolve(**{'If-Modified-Since': 'yesterday'}).status, 200)
+
+    def test_if_range(self):
+        for value, status in ((self.etag, 206), ('W/' + self.etag, 200), ('"other"', 200),
+                              (self.last_modified, 206), ('Mon, 01 Jan 2001 00:00:00 GMT', 200)):
+            response = self.resolve(Range='bytes=0-9', **{'If-Range': value})
+            self.assertEqual(response.status, status, value)
+            self.assertEqual(response.body, self.content[:10] if status == 206 else self.content)
+
+
+class FakeClock:
+    """time.monotonic and time.sleep, with time only passing when slept"""
+
+    def __init__(self):
+        self.now = 100.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class PacingTest(unittest.TestCase):
+    def test_split_chunks(self):
+        parts = [b'abcde', b'f', b'', b'ghijklmnopq', b'rs']
+        chunks = list(webserver.split_chunks(parts, 4))
+        self.assertEqual([bytes(chunk) for chunk in chunks], [b'abcd', b'efgh', b'ijkl', b'mnop', b'qrs'])
+        self.assertEqual(list(webserver.split_chunks([b'abcd'], 4)), [b'abcd'])
+        self.assertEqual(list(webserver.split_chunks([], 4)), [])
+
+        body = bytes(range(256)) * 40
+        parts = [body[i:j] for i, j in ((0, 1), (1, 1000), (1000, 1001), (1001, 5000), (5000, len(body)))]
+        for size in (1, 7, 1460, 20000):
+            chunks = list(webserver.split_chunks(parts, size))
+            self.assertEqual(b''.join(chunks), body, size)
+            self.assertTrue(all(len(chunk) == size for chunk in chunks[:-1]), size)
+
+    def test_pace_chunks(self):
+        chunks = [b'a' * 100, b'b' * 50, b'c' * 10]
+        # no pause before the first chunk, then the chunk delay and the time the previous chunk takes at rate
+        self.assertEqual([pause for pause, chunk in webserver.pace_chunks(chunks, 1000, 0)], [0, 0.1, 0.05])
+        self.assertEqual([pause for pause, chunk in webserver.pace_chunks(chunks, 0, 250)], [0, 0.25, 0.25])
+        self.assertEqual([pause for pause, chunk in webserver.pace_chunks(chunks, 100, 500)], [0, 1.5, 1.0])
+        self.assertEqual([chunk for pause, chunk in webserver.pace_chunks(chunks, 100, 500)], chunks)
+
+    def test_send_paced(self):
+        handler = webserver.Handler.__new__(webserver.Handler)
+        handler.wfile = io.BytesIO()
+        clock = FakeClock()
+
+        def slow_write(data, write=handler.wfile.write):
+            # a write taking time of its own is part of the pause before the next chunk
+            clock.now += 0.02
+            return write(data)
+        handler.wfile.write = slow_write
+
+        chunks = webserver.split_chunks([b'x' * 250], 100)
+        with unittest.mock.patch.object(webserver.time, 'monotonic', clock.monotonic), \
+                unittest.mock.patch.object(webserver.time, 'sleep', clock.sleep):
+            handler.send_paced(webserver.pace_chunks(chunks, 1000, 100))
+
+        self.assertEqual(handler.wfile.getvalue(), b'x' * 250)
+        self.assertEqual([round(pause, 6) for pause in clock.sleeps], [0.18, 0.18])
+        self.assertAlmostEqual(clock.now, 100.0 + 0.2 + 0.2 + 0.02)
+
+
+def decode_chunked(data):
+    """Return (chunk sizes, body, trailer lines) of a body in the chunked transfer coding, asserting its framing"""
+    sizes = []
+    body = b''
+    while True:
+        size_line, _, data = data.partition(b'\r\n')
+        size = int(size_line, 16)
+        if size == 0:
+            break
+        sizes.append(size)
+        body += data[:size]
+        assert data[size:size + 2] == b'\r\n'
+        data = data[size + 2:]
+
+    # the trailer lines, each ending with CRLF, then the empty line
+    assert data.endswith(b'\r\n')
+    return sizes, body, data[:-2].decode('latin-1').split('\r\n')[:-1]
+
+
+class ChunkedTest(FixtureTreeTestCase):
+    def test_parse_chunk_layout(self):
+        self.assertEqual(webserver.parse_chunk_layout('100,1K').sizes, (100, 1024))
+        layout = webserver.parse_chunk_layout('random 1-4K 7')
+        self.assertEqual((layout.size_range, layout.seed), ((1, 4096), 7))
+        for text in ('', '0', '10,-1', 'random 5-1', 'random 0-10', 'random 1-10 x', 'ten'):
+            with self.assertRaises(ValueError, msg=text):
+                webserver.parse_chunk_layout(text)
+
+    def test_layout_spanning_parts(self):
+        parts = [b'abc', b'', b'defghij', b'k', b'lmnopqrstuvwxyz']
+        body = b''.join(parts)
+        chunks = [bytes(chunk) for chunk in webserver.layout_chunks(parts, itertools.cycle((4, 1)))]
+        self.assertEqual(b''.join(chunks), body)
+        self.assertEqual([len(chunk) for chunk in chunks], [4, 1] * 5 + [1])
+
+    def test_seeded_random_layout(self):
+        layout = webserver.parse_chunk_layout('random 3-9 42')
+        body = bytes(range(200))
+        chunks = [bytes(chunk) for chunk in webserver.layout_chunks([body[:50], body[50:]], layout.chunk_sizes())]
+        self.assertEqual(b''.join(chunks), body)
+        self.assertTrue(all(3 <= len(chunk) <= 9 for chunk in chunks[:-1]))
+        # the same seed gives the same layout
+        sizes = list(itertools.islice(layout.chunk_sizes(), len(chunks) - 1))
+        self.assertEqual([len(chunk) for chunk in chunks[:-1]], sizes)
+
+    def test_frame_chunks(self):
+        framed = b''.join(webserver.frame_chunks([b'abc', b'', b'de'], ['X-Sum: 5', 'X-Host: d.test']))
+        self.assertEqual(framed, b'3\r\nabc\r\n2\r\nde\r\n0\r\nX-Sum: 5\r\nX-Host: d.test\r\n\r\n')
+        self.assertEqual(decode_chunked(framed), ([3, 2], b'abcde', ['X-Sum: 5', 'X-Host: d.test']))
+        self.assertEqual(b''.join(webserver.frame_chunks([])), b'0\r\n\r\n')
+
+    def resolve(self, path, request_version='HTTP/1.1'):
+        response = webserver.FixtureResolver().resolve('s1.t1.d.test', path, request_version=request_version)
+        return response, dict(response.headers), b''.join(bytes(chunk) for chunk in response.body)
+
+    def test_chunked_fixture(self):
+        content = ''.join('line %d of {DOMAIN}\n' % i for i in range(100))
+        write_fixture(self.root, "t1/s1/c.txt", content)
+        write_fixture(self.root, "t1/s1/c.txt.chunked", "100,7")
+        write_fixture(self.root, "t1/s1/c.txt.chunk-trailers", "X-Origin: {DOMAIN}\nX-Json: {}\n")
+        body = content.replace('{DOMAIN}', 'd.test').encode()
+
+        response, headers, framed = self.resolve('/c.txt')
+        self.assertEqual(headers['Transfer-Encoding'], 'chunked')
+        self.assertEqual(headers['Trailer'], 'X-Origin, X-Json')
+        self.assertNotIn('Content-Length', headers)
+        sizes, decoded, trailers = decode_chunked(framed)
+        self.assertEqual(decoded, body)
+        self.assertEqual(sizes[:-1], [100, 7] * (len(sizes) // 2))
+        self.assertEqual(trailers, ['X-Origin: d.test', 'X-Json: {}'])
+
+        # HTTP/1.0 has no chunked coding, the plain body ends with the connection
+        response, headers, plain = self.resolve('/c.txt', 'HTTP/1.0')
+        self.assertNotIn('Transfer-Encoding', headers)
+        self.assertTrue(response.close)
+        self.assertEqual(plain, body)
+
+
+class KeepAliveTest(FixtureTreeTestCase):
+    def setUp(self):
+        FixtureTreeTestCase.setUp(self)
+        write_fixture(self.root, "t1/s1/n.html", "body of a 304\n")
+        write_fixture(self.root, "t1/s1/n.html.status-code", "304")
+        write_fixture(self.root, "t1/s1/e.html", "body of a 204\n")
+        write_fixture(self.root, "t1/s1/e.html.status-code", "204")
+        write_fixture(self.root, "t1/s1/ok.html", "ok\n")
+
+    def get(self, connection, method, path):
+        connection.request(method, path, headers={'Host': 's1.t1.example.com'})
+        response = connection.getresponse()
+        return response, response.read()
+
+    def check_bodyless_then_ok(self, engine):
+        self.start_webserver(engine=engine)
+        connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=5)
+        self.addCleanup(connection.close)
+
+        for path, status in (('/n.html', 304), ('/e.html', 204)):
+            response, body = self.get(connection, 'GET', path)
+            self.assertEqual((response.status, body), (status, b''))
+            self.assertIsNone(response.getheader('Content-Length'))
+
+            # the next response on the same connection must not start with the fixture's body
+            response, body = self.get(connection, 'GET', '/ok.html')
+            self.assertEqual((response.status, body), (200, b'ok\n'))
+
+        response, body = self.get(connection, 'HEAD', '/ok.html')
+        self.assertEqual((response.status, body, response.getheader('Content-Length')), (200, b'', '3'))
+        response, body = self.get(connection, 'GET', '/ok.html')
+        self.assertEqual((response.status, body), (200, b'ok\n'))
+
+    def test_bodyless_status_threaded(self):
+        self.check_bodyless_then_ok(webserver.ENGINE_THREADED)
+
+    def test_bodyless_status_asyncio(self):
+        self.check_bodyless_then_ok(webserver.ENGINE_ASYNCIO)
+
+
+class HostAddressTest(FixtureTreeTestCase):
+    def setUp(self):
+        FixtureTreeTestCase.setUp(self)
+        write_fixture(self.root, "README", "stray top level file\n")
+        write_fixture(self.root, "t1/README", "testset description\n")
+        write_fixture(self.root, "t1/s1/f1.html", "f1\n")
+        write_fixture(self.root, "t1/s2.site", "pages 10\n")
+
+    def test_only_hosts_are_registered(self):
+        routes = webserver.RouteTable.build(self.root)
+        self.assertFalse(routes.has_testset('README'))
+        self.assertEqual(routes.servers(), {('t1', 's1'), ('t1', 's2')})
+
+    def test_host_addresses(self):
+        test_webserver = self.start_webserver(per_host_ips=True)
+        self.assertEqual(test_webserver.host_addresses, {('t1', 's1'): '127.1.0.1', ('t1', 's2'): '127.1.0.2'})
+        self.assertIsNone(test_webserver.resolve_host(['README', 't1']))
+        self.assertIsNone(test_webserver.resolve_host(['s2.site', 't1']))
+
+    def test_dns_answers(self):
+        dns_port = next(PORTS)
+        self.start_webserver(per_host_ips=True, dns_port=dns_port, dns_domain='privacore.test')
+        resolver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(resolver.close)
+        resolver.settimeout(5)
+
+        for name, addresses in (('s1.t1.privacore.test', ['127.1.0.1']), ('s2.t1.privacore.test', ['127.1.0.2']),
+                                ('README.t1.privacore.test', [])):
+            resolver.sendto(test_dnsserver.query(name), ('127.0.0.1', dns_port))
+            self.assertEqual(test_dnsserver.parse_response(resolver.recv(512))[4], addresses, name)
+
+
+class LoggingTest(FixtureTreeTestCase):
+    def setUp(self):
+        FixtureTreeTestCase.setUp(self)
+        write_fixture(self.root, "t1/s1/f1.html", "f1\n")
+
+    def get(self, path):
+        connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=5)
+        connection.request('GET', path, headers={'Host': 's1.t1.example.com'})
+        connection.getresponse().read()
+        connection.close()
+
+    def access_log_urls(self, path):
+        with open(path) as f:
+            return [json.loads(line)['url'] for line in f]
+
+    def test_access_logs_of_two_webservers(self):
+        first_log = os.path.join(self.root, 'first.jsonl')
+        second_log = os.path.join(self.root, 'second.jsonl')
+        first = self.start_webserver(access_log=first_log)
+        first_port = self.port
+        second = self.start_webserver(access_log=second_log, log_queue=True)
+
+        self.get('/f1.html?second')
+        self.port = first_port
+        self.get('/f1.html?first')
+        second.stop()
+        first.stop()
+
+        self.assertEqual(self.access_log_urls(first_log), ['http://s1.t1.example.com:%d/f1.html?first' % first_port])
+        self.assertEqual([url.rpartition('?')[2] for url in self.access_log_urls(second_log)], ['second'])
+        self.assertEqual(first.access_log.logger.handlers, [])
+        self.assertTrue(first.access_log.handler.stream is None)
+
+    def test_log_queue_restores_handlers(self):
+        test_webserver = self.start_webserver(log_queue=True)
+        handlers = test_webserver.log_handlers
+        self.assertNotEqual(logging.getLogger().handlers, handlers)
+        test_webserver.stop()
+        self.assertEqual(logging.getLogger().handlers, handlers)
+
+    def test_workers_log_through_parent(self):
+        test_webserver = self.start_webserver(workers=2)
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        logging.getLogger().addHandler(handler)
+        self.addCleanup(logging.getLogger().removeHandler, handler)
+
+        test_webserver.stop()
+        worker_pids = {worker.process.pid for worker in test_webserver.workers}
+        stopping = {record.process for record in records if record.getMessage() == 'webserver stopping'}
+        self.assertEqual(stopping, worker_pids | {os.getpid()})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -9,6 +9,8 @@ import sys
 import glob
 import shutil
 import ast
+import json
+import politeness
 from gigablast import GigablastAPI, GigablastInstances
 from junit_xml import TestSuite, TestCase
 from urllib.parse import parse_qs
@@ -56,6 +58,9 @@ class TestRunner:
                 if not self.run_instructions():
                     self.run_testcase()
 
+                # how the crawler spread its requests over the test hosts
+                self.add_politeness_report()
+
                 # stop & cleanup
                 self.stop_gb()
 
@@ -330,6 +335,15 @@ class TestRunner:
 
         self.testcases.append(testcase)
 
+    def add_politeness_report(self):
+        report = politeness.host_report(self.webserver.get_served_urls().records())
+        for host, host_report in sorted(report['hosts'].items()):
+            print('Politeness', host, host_report['connection_concurrency'], host_report['request_gaps']['p50'])
+            self.testcases.append(TestCase('politeness - ' + host,
+                                           classname='systemtest.' + str(self.gb_instances.offset) + '.' +
+                                                     self.testcasedesc,
+                                           stdout=json.dumps(host_report, indent=2)))
+
     def get_testsuite(self):
         return TestSuite(self.testcase, test_cases=self.testcases, package='systemtest')
 
@@ -689,8 +703,9 @@ class TestRunner:
             for url in formated_items:
                 self.add_testcase(test_type, url, start_time, (url not in served_urls))
 
+            formated_item_set = set(formated_items)
             for url in served_urls:
-                if url not in formated_items:
+                if url not in formated_item_set:
                     self.add_testcase(test_type, url, start_time, True)
 
     def verify_not_spidered(self, *args):
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 from http.server import HTTPServer, BaseHTTPRequestHandler
+import http.client
 from socketserver import ThreadingMixIn
 import urllib.parse as urlparse
 import urllib.parse as urllib
@@ -11,14 +12,50 @@ import os
 import argparse
 import logging
 import logging.config
+import logging.handlers
+import queue
+import random
 import ssl
 import time
-import cgi
+import html
+import ipaddress
 import socket
 import struct
-import math
-
-global logger
+import gzip
+import zlib
+import collections
+import codecs
+import errno
+import array
+import re
+import types
+import functools
+import asyncio
+import io
+import itertools
+import json
+import bisect
+import email.message
+import email.utils
+import multiprocessing
+import multiprocessing.connection
+
+import bodygen
+import dnsserver
+import fixturepack
+import sitegen
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import tomllib
+except ImportError:
+    tomllib = None
+
+logger = logging.getLogger(__name__)
 
 root_dir = "tests"
 
@@ -27,6 +64,1276 @@ def unescape_path(s):
     return urllib.unquote(s)
 
 
+ENGINE_THREADED = 'threaded'
+ENGINE_ASYNCIO = 'asyncio'
+
+ACTION_WRITE = 'write'
+ACTION_DELAY = 'delay'
+ACTION_RESET = 'reset'
+ACTION_SENDFILE = 'sendfile'
+ACTION_STREAM = 'stream'
+ACTION_PACE = 'pace'
+
+# chunk size for paced bodies when the fixture has no content-mtu
+PACED_CHUNK_SIZE = 1460
+
+# placeholders substituted in text fixtures, any other braces are literal text
+TEMPLATE_PLACEHOLDER_RE = re.compile(r'\{(SCHEME|DOMAIN|PORT)\}')
+
+# first of the loopback addresses given to test hosts with per_host_ips, the listeners bind to all of 127/8
+LOOPBACK_BASE = ipaddress.IPv4Address('127.1.0.1')
+LOOPBACK_LAST = ipaddress.IPv4Address('127.255.255.254')
+
+# Host names answered by the control endpoints (eg. /_stats) instead of fixtures
+CONTROL_HOSTS = frozenset(('control', 'localhost', '127.0.0.1'))
+# /_tenants/<tenant>/<action> on the control hosts
+CONTROL_TENANT_RE = re.compile(r'/_tenants/([A-Za-z0-9-]+)/(served_urls|clear)')
+
+# upper bounds in seconds of the latency histogram buckets, the last bucket counts everything slower
+LATENCY_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 30)
+# seconds requests per second is averaged over
+RATE_WINDOW = 10
+
+# fixture sidecars, read from <file>.<setting> or from default-<setting> for a whole directory
+SIDECAR_SETTINGS = ('status-code', 'content-type', 'charset', 'content-encoding', 'extra-headers', 'connection-reset',
+                    'connection-delay', 'content-mtu', 'content-rate', 'content-chunk-delay', 'generate', 'etag',
+                    'last-modified', 'accept-ranges', 'chunked', 'chunk-trailers')
+# per-directory manifests holding the same settings for many files at once, the first one found is used
+MANIFEST_NAMES = ('_fixtures.json', '_fixtures.toml')
+# not listed on index pages
+HIDDEN_ENDINGS = frozenset('.' + setting for setting in SIDECAR_SETTINGS)
+HIDDEN_FILES = frozenset(('README', 'robots.txt') + MANIFEST_NAMES +
+                         tuple('default-' + setting for setting in SIDECAR_SETTINGS))
+
+GZIP_MAGIC = b'\x1f\x8b'
+COMPRESSIBLE_TYPES = ('text/', 'application/json', 'application/javascript', 'application/xml',
+                      'application/xhtml+xml', 'application/rss+xml', 'application/atom+xml')
+
+ROUTE_FILE = 'file'
+ROUTE_INDEX = 'index'
+ROUTE_NOINDEX = 'noindex'
+ROUTE_RESET = 'reset'
+
+# etag sidecar value asking for a tag hashed from the file content instead of its mtime and size
+ETAG_CONTENT_HASH = 'content-hash'
+
+RANGE_SPEC_RE = re.compile(r'(\d*)-(\d*)')
+
+Route = collections.namedtuple('Route', ['kind', 'file_path', 'status_code', 'content_type', 'charset',
+                                         'content_encoding', 'content_mtu', 'extra_headers', 'connection_delay',
+                                         'generate', 'negotiate', 'content_rate', 'content_chunk_delay', 'etag',
+                                         'last_modified', 'accept_ranges', 'chunked', 'chunk_trailers'],
+                               defaults=(200, None, None, None, 0, (), 0, None, False, 0, 0, None, None, True, None,
+                                         ()))
+
+
+def is_templated(content_type, content_encoding):
+    if content_type is None:
+        content_type = 'text/plain'
+    return content_type.startswith('text/') and content_encoding is None
+
+
+def supported_encodings():
+    """Content codings we can produce, in order of preference"""
+    if brotli is not None:
+        return ('br', 'gzip', 'deflate')
+    return ('gzip', 'deflate')
+
+
+def negotiate_encoding(accept_encoding):
+    """Pick the best supported content coding from an Accept-Encoding header, None for identity"""
+    if not accept_encoding:
+        return None
+
+    qualities = {}
+    for item in accept_encoding.split(','):
+        coding, _, params = item.partition(';')
+        coding = coding.strip().lower()
+        if coding == 'x-gzip':
+            coding = 'gzip'
+
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        qualities[coding] = quality
+
+    best, best_quality = None, 0.0
+    for coding in supported_encodings():
+        quality = qualities.get(coding, qualities.get('*', 0.0))
+        if quality > best_quality:
+            best, best_quality = coding, quality
+
+    return best
+
+
+def compress(content, encoding):
+    if encoding == 'gzip':
+        # fixtures may already be stored gzipped
+        if content[:2] == GZIP_MAGIC:
+            return content
+        return gzip.compress(content, mtime=0)
+    if encoding == 'deflate':
+        return zlib.compress(content)
+    if encoding == 'br':
+        return brotli.compress(content)
+    return content
+
+
+def encode_chunk(data):
+    return b'%x\r\n' % len(data) + data + b'\r\n'
+
+
+def fill_placeholders(text, scheme, domain, port):
+    """text with its {SCHEME}, {DOMAIN} and {PORT} placeholders filled in, any other braces left as they are"""
+    values = {'SCHEME': scheme, 'DOMAIN': domain, 'PORT': port}
+    return TEMPLATE_PLACEHOLDER_RE.sub(lambda match: str(values[match.group(1)]), text)
+
+
+class Template:
+    """Text fixture compiled into pre-encoded literal segments (even indices) and placeholder names (odd indices),
+    so a request only splices in its scheme, domain and port"""
+
+    def __init__(self, segments, charset):
+        self.segments = segments
+        self.charset = charset
+        self.size = sum(len(segment) for segment in segments[::2])
+        self.placeholders = collections.Counter(segments[1::2])
+
+    def __len__(self):
+        # size of the literal text, for the body cache accounting
+        return self.size
+
+    @classmethod
+    def compile(cls, content, charset):
+        # one encoder for all literals, so a BOM is only written in front of the first one
+        encoder = codecs.getincrementalencoder(charset)()
+        parts = TEMPLATE_PLACEHOLDER_RE.split(content.decode(charset))
+        return cls([part if i % 2 else encoder.encode(part) for i, part in enumerate(parts)], charset)
+
+    def encode_values(self, scheme, domain, port):
+        encoder = codecs.getincrementalencoder(self.charset)()
+        encoder.encode('')
+        return {'SCHEME': encoder.encode(scheme), 'DOMAIN': encoder.encode(domain), 'PORT': encoder.encode(str(port))}
+
+    def length(self, values):
+        return self.size + sum(len(values[name]) * count for name, count in self.placeholders.items())
+
+    def render(self, values):
+        return b''.join(values[segment] if i % 2 else segment for i, segment in enumerate(self.segments))
+
+    def chunks(self, values, chunk_size=bodygen.CHUNK_SIZE):
+        """Yield the rendered body in blocks of about chunk_size bytes, large literals as they are"""
+        block = []
+        block_size = 0
+        for i, segment in enumerate(self.segments):
+            if i % 2:
+                segment = values[segment]
+            elif len(segment) >= chunk_size:
+                if block:
+                    yield b''.join(block)
+                    block = []
+                    block_size = 0
+                yield segment
+                continue
+
+            block.append(segment)
+            block_size += len(segment)
+            if block_size >= chunk_size:
+                yield b''.join(block)
+                block = []
+                block_size = 0
+
+        if block:
+            yield b''.join(block)
+
+
+def parse_http_date(value):
+    """Seconds since the epoch of an HTTP date, None if it can't be parsed"""
+    try:
+        parsed = email.utils.parsedate_tz(value)
+    except (TypeError, ValueError):
+        return None
+    if parsed is None:
+        return None
+    return email.utils.mktime_tz(parsed)
+
+
+def etag_matches(header, etag, weak=True):
+    """Whether etag is listed in an If-None-Match (weak comparison) or If-Range (strong comparison) header"""
+    if header.strip() == '*':
+        return True
+
+    tags = [tag.strip() for tag in header.split(',')]
+    if weak:
+        etag = etag[2:] if etag.startswith('W/') else etag
+        return any((tag[2:] if tag.startswith('W/') else tag) == etag for tag in tags)
+    return not etag.startswith('W/') and etag in tags
+
+
+def parse_range(value, length):
+    """Return the (start, end) byte ranges of a Range header for a body of length, end exclusive.
+    [] when none of them is satisfiable, None for a header that is invalid and so ignored"""
+    unit, _, specs = value.partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+
+    ranges = []
+    for spec in specs.split(','):
+        match = RANGE_SPEC_RE.fullmatch(spec.strip())
+        if match is None or match.group() == '-':
+            return None
+
+        first, last = match.groups()
+        if not first:
+            # suffix range, the last bytes of the body
+            if int(last) > 0 and length > 0:
+                ranges.append((max(0, length - int(last)), length))
+            continue
+
+        start = int(first)
+        end = int(last) + 1 if last else length
+        if last and end <= start:
+            return None
+        if start < length:
+            ranges.append((start, min(end, length)))
+
+    return ranges
+
+
+def byteranges_heads(boundary, content_type, ranges, length):
+    """Return the delimiter and headers in front of each part of a multipart/byteranges body, followed by the
+    closing delimiter"""
+    heads = []
+    for start, end in ranges:
+        head = '\r\n--' + boundary + '\r\n'
+        if content_type is not None:
+            head += 'Content-Type: ' + content_type + '\r\n'
+        head += 'Content-Range: bytes %d-%d/%d\r\n\r\n' % (start, end - 1, length)
+        heads.append(head.encode('latin-1'))
+
+    heads.append(('\r\n--' + boundary + '--\r\n').encode('latin-1'))
+    return heads
+
+
+def byteranges_chunks(heads, ranges, read):
+    """Yield a multipart/byteranges body, read(start, end) yielding the bytes of a range"""
+    for head, (start, end) in zip(heads, ranges):
+        yield head
+        yield from read(start, end)
+    yield heads[-1]
+
+
+def read_file_range(path, start, end):
+    with open(path, "rb") as f:
+        f.seek(start)
+        while start < end:
+            chunk = f.read(min(bodygen.CHUNK_SIZE, end - start))
+            if not chunk:
+                break
+            start += len(chunk)
+            yield chunk
+
+
+def is_paced(route):
+    return route.content_mtu > 0 or route.content_rate > 0 or route.content_chunk_delay > 0
+
+
+def paced_chunk_size(route):
+    if route.content_mtu > 0:
+        return route.content_mtu
+    if route.content_rate > 0:
+        # roughly ten writes per second
+        return max(1, route.content_rate // 10)
+    return PACED_CHUNK_SIZE
+
+
+def split_chunks(parts, size):
+    """Yield size byte slices of the concatenated parts. Slices are memoryviews into the parts, only a slice
+    spanning two parts is copied"""
+    pending = b''
+    for part in parts:
+        view = memoryview(part)
+        if pending:
+            take = size - len(pending)
+            pending += view[:take]
+            view = view[take:]
+            if len(pending) < size:
+                continue
+            yield pending
+            pending = b''
+
+        whole = len(view) - len(view) % size
+        for i in range(0, whole, size):
+            yield view[i:i + size]
+        pending = bytes(view[whole:])
+
+    if pending:
+        yield pending
+
+
+def pace_chunks(chunks, rate, chunk_delay):
+    """Yield (pause, chunk) pairs, pause being the seconds to wait before sending chunk so the body goes out at
+    no more than rate bytes per second (0 for unlimited) with chunk_delay milliseconds between chunks"""
+    pause = 0
+    for chunk in chunks:
+        yield pause, chunk
+        pause = chunk_delay / 1000
+        if rate > 0:
+            pause += len(chunk) / rate
+
+
+class ChunkLayout:
+    """Sizes of the chunks of a chunked fixture, either a list of sizes used in turn or sizes picked from
+    [low, high] by a seeded random generator"""
+
+    def __init__(self, sizes=None, size_range=None, seed=0):
+        self.sizes = sizes
+        self.size_range = size_range
+        self.seed = seed
+
+    def __repr__(self):
+        if self.sizes is not None:
+            return 'ChunkLayout(%s)' % ','.join(str(size) for size in self.sizes)
+        return 'ChunkLayout(random %d-%d %d)' % (self.size_range + (self.seed,))
+
+    def chunk_sizes(self):
+        if self.sizes is not None:
+            return itertools.cycle(self.sizes)
+        rnd = random.Random(self.seed)
+        low, high = self.size_range
+        return iter(lambda: rnd.randint(low, high), None)
+
+
+def parse_chunk_layout(text):
+    """Parse a chunked sidecar:
+        <size>[,<size>...]          chunk sizes used in turn, the last chunk of the body may be shorter
+        random <min>-<max> [<seed>] sizes picked from min to max with a seeded random generator
+    Sizes accept K/M/G suffixes"""
+    tokens = text.split()
+    try:
+        if tokens and tokens[0] == 'random' and len(tokens) in (2, 3):
+            low, _, high = tokens[1].partition('-')
+            layout = ChunkLayout(size_range=(bodygen.parse_size(low), bodygen.parse_size(high)),
+                                 seed=int(tokens[2]) if len(tokens) == 3 else 0)
+            if 0 < layout.size_range[0] <= layout.size_range[1]:
+                return layout
+        elif len(tokens) == 1:
+            layout = ChunkLayout(sizes=tuple(bodygen.parse_size(size) for size in tokens[0].split(',')))
+            if min(layout.sizes) > 0:
+                return layout
+    except ValueError:
+        pass
+
+    raise ValueError('invalid chunk layout: %s' % text)
+
+
+def layout_chunks(parts, sizes):
+    """Yield slices of the concatenated parts with lengths taken in turn from sizes, the last one possibly
+    shorter. Like split_chunks, only a slice spanning two parts is copied"""
+    sizes = iter(sizes)
+    size = next(sizes)
+    pending = []
+    pending_size = 0
+    for part in parts:
+        view = memoryview(part)
+        while len(view) > 0:
+            take = size - pending_size
+            if take > len(view):
+                pending.append(bytes(view))
+                pending_size += len(view)
+                break
+
+            if pending:
+                pending.append(view[:take])
+                yield b''.join(pending)
+                pending = []
+                pending_size = 0
+            else:
+                yield view[:take]
+            view = view[take:]
+            size = next(sizes)
+
+    if pending:
+        yield b''.join(pending)
+
+
+def frame_chunks(chunks, trailers=()):
+    """Yield chunks in the chunked transfer coding, ending with the last chunk and the trailer fields"""
+    for chunk in chunks:
+        # an empty chunk would end the body early
+        if len(chunk) > 0:
+            yield encode_chunk(chunk)
+
+    yield b'0\r\n' + b''.join(trailer.encode('latin-1') + b'\r\n' for trailer in trailers) + b'\r\n'
+
+
+def read_setting(path):
+    with open(path, "rb") as f:
+        return f.read().decode().strip()
+
+
+def parse_setting(value, default):
+    """Convert a sidecar's text or a manifest value to the type of default"""
+    if value is None:
+        # null in a manifest clears a setting, as an empty sidecar does
+        value = ''
+    if type(default) is int:
+        return int(value)
+    if type(default) is tuple:
+        return tuple(value) if isinstance(value, list) else tuple(value.split('\n'))
+    return str(value)
+
+
+def read_manifest(path):
+    """Return (defaults, files) from a manifest:
+        {"default": {<setting>: <value>, ...}, "files": {<name>: {<setting>: <value>, ...}, ...}}
+    as JSON or TOML. Values are what the sidecar files would hold, extra-headers may also be a list"""
+    if path.endswith('.toml'):
+        if tomllib is None:
+            raise ValueError('%s needs tomllib (Python 3.11)' % path)
+        with open(path, "rb") as f:
+            manifest = tomllib.load(f)
+    else:
+        with open(path, "rb") as f:
+            manifest = json.load(f)
+
+    defaults = manifest.get('default', {})
+    files = manifest.get('files', {})
+    for settings in [defaults] + list(files.values()):
+        unknown = set(settings) - set(SIDECAR_SETTINGS)
+        if unknown:
+            raise ValueError('unknown settings in %s: %s' % (path, ', '.join(sorted(unknown))))
+    return defaults, files
+
+
+class DirectorySettings:
+    """Overrides for the files of one directory, from <file>.<setting> and default-<setting> sidecars and from the
+    directory's manifest. The directory is listed and the manifest parsed once, not probed for every setting.
+
+    Sidecar files win over the manifest, per-file settings over directory defaults."""
+
+    def __init__(self, dir_path, file_names):
+        self.dir_path = dir_path
+        self.file_names = frozenset(file_names)
+        self.defaults = {}
+        self.files = {}
+        for manifest in MANIFEST_NAMES:
+            if manifest in self.file_names:
+                self.defaults, self.files = read_manifest(os.path.join(dir_path, manifest))
+                break
+
+    def names(self):
+        """Fixture names of the directory, including those only described by a generate recipe"""
+        names = set(self.file_names)
+        names.update(name[:-len('.generate')] for name in self.file_names if name.endswith('.generate'))
+        names.update(name for name, settings in self.files.items() if 'generate' in settings)
+        return names
+
+    def has(self, name, setting):
+        """Whether the file itself has setting, as connection-reset only needs to be present"""
+        return name + '.' + setting in self.file_names or bool(self.files.get(name, {}).get(setting))
+
+    def get(self, name, setting, default):
+        sidecar = name + '.' + setting
+        if sidecar in self.file_names:
+            return parse_setting(read_setting(os.path.join(self.dir_path, sidecar)), default)
+
+        file_settings = self.files.get(name, {})
+        if setting in file_settings:
+            return parse_setting(file_settings[setting], default)
+
+        if 'default-' + setting in self.file_names:
+            return parse_setting(read_setting(os.path.join(self.dir_path, 'default-' + setting)), default)
+
+        if setting in self.defaults:
+            return parse_setting(self.defaults[setting], default)
+
+        return default
+
+
+def resolve_file_route(base_path, name, settings=None):
+    if settings is None:
+        dir_path = os.path.dirname(base_path)
+        settings = DirectorySettings(dir_path, os.listdir(dir_path))
+
+    if settings.has(name, 'connection-reset'):
+        return Route(ROUTE_RESET, base_path, status_code=0)
+
+    # Setup defaults
+    status_code = 200
+    content_type = "application/octet-stream"
+    content_encoding = None
+    content_mtu = 0
+    content_rate = 0
+    content_chunk_delay = 0
+    charset = None
+    extra_headers = ()
+    connection_delay = 0
+
+    # try guessing default from mime
+    mime = mimetypes.guess_type(name, False)
+    if mime[0] is not None:
+        content_type = mime[0]
+    if content_type.startswith('text/'):
+        charset = 'UTF-8'
+
+    # look for overrides
+    status_code = settings.get(name, 'status-code', status_code)
+    content_type = settings.get(name, 'content-type', content_type)
+    charset = settings.get(name, 'charset', charset)
+    content_encoding = settings.get(name, 'content-encoding', content_encoding)
+    content_mtu = settings.get(name, 'content-mtu', content_mtu)
+    # bytes per second and milliseconds between chunks
+    content_rate = settings.get(name, 'content-rate', content_rate)
+    content_chunk_delay = settings.get(name, 'content-chunk-delay', content_chunk_delay)
+    extra_headers = settings.get(name, 'extra-headers', extra_headers)
+    connection_delay = settings.get(name, 'connection-delay', connection_delay)
+    generate = settings.get(name, 'generate', None)
+    # validators are generated from the file unless given, an empty sidecar leaves them out
+    etag = settings.get(name, 'etag', None)
+    last_modified = settings.get(name, 'last-modified', None)
+    accept_ranges = settings.get(name, 'accept-ranges', 'bytes') != 'none'
+    # chunk layout of a body sent with Transfer-Encoding: chunked, and the trailer fields after its last chunk
+    chunked = settings.get(name, 'chunked', None)
+    chunk_trailers = settings.get(name, 'chunk-trailers', ())
+
+    if content_type == "":
+        content_type = None
+    if charset == "":
+        charset = None
+    if content_encoding == "":
+        content_encoding = None
+
+    if etag and etag != ETAG_CONTENT_HASH and not etag.startswith(('"', 'W/"')):
+        etag = '"' + etag + '"'
+
+    chunked = parse_chunk_layout(chunked) if chunked else None
+    chunk_trailers = tuple(trailer for trailer in chunk_trailers if ':' in trailer)
+
+    negotiate = (content_encoding == 'negotiate')
+    if negotiate:
+        content_encoding = None
+
+    if generate is not None:
+        generate = bodygen.parse_recipe(generate)
+        if content_encoding is None:
+            content_encoding = generate.content_encoding()
+
+    return Route(ROUTE_FILE, base_path, status_code, content_type, charset, content_encoding, content_mtu,
+                 extra_headers, connection_delay, generate, negotiate, content_rate, content_chunk_delay, etag,
+                 last_modified, accept_ranges, chunked, chunk_trailers)
+
+
+class RouteTable:
+    """Fixture routes keyed by (testset, server, path), resolved once from the test directory. Servers declared
+    by a <server>.site spec are virtual, their pages are generated by sitegen"""
+
+    def __init__(self, routes, testsets, servers, sites):
+        self._routes = types.MappingProxyType(routes)
+        self._testsets = frozenset(testsets)
+        self._servers = frozenset(servers)
+        self._sites = types.MappingProxyType(sites)
+
+    @classmethod
+    def build(cls, root):
+        routes = {}
+        testsets = set()
+        servers = set()
+        sites = {}
+
+        # only directories and site specs are hosts, other files next to them (READMEs, scripts) aren't
+        for testset in os.listdir(root):
+            testset_path = os.path.join(root, testset)
+            if not os.path.isdir(testset_path):
+                continue
+            testsets.add(testset)
+
+            for server in os.listdir(testset_path):
+                server_path = os.path.join(testset_path, server)
+                if server.endswith('.site') and os.path.isfile(server_path):
+                    site_name = server[:-len('.site')]
+                    servers.add((testset, site_name))
+                    sites[(testset, site_name)] = sitegen.parse_spec(read_setting(server_path))
+                    continue
+
+                if not os.path.isdir(server_path):
+                    continue
+                servers.add((testset, server))
+
+                for dir_path, dir_names, file_names in os.walk(server_path):
+                    rel_path = os.path.relpath(dir_path, server_path)
+                    prefix = '' if rel_path == '.' else '/' + rel_path.replace(os.sep, '/')
+
+                    # a generate recipe doesn't need the file it describes to exist
+                    settings = DirectorySettings(dir_path, file_names)
+
+                    file_routes = {}
+                    for name in sorted(settings.names()):
+                        file_routes[name] = resolve_file_route(os.path.join(dir_path, name), name, settings)
+                        routes[(testset, server, prefix + '/' + name)] = file_routes[name]
+
+                    if 'index.html' in file_routes:
+                        dir_route = file_routes['index.html']
+                    elif '_noindex' in file_routes:
+                        dir_route = Route(ROUTE_NOINDEX, dir_path, status_code=404)
+                    else:
+                        dir_route = Route(ROUTE_INDEX, dir_path, content_type='text/html')
+
+                    routes[(testset, server, prefix)] = dir_route
+                    routes[(testset, server, prefix + '/')] = dir_route
+
+        return cls(routes, testsets, servers, sites)
+
+    def has_testset(self, testset):
+        return testset in self._testsets
+
+    def has_server(self, testset, server):
+        return (testset, server) in self._servers
+
+    def servers(self):
+        return self._servers
+
+    def site(self, testset, server):
+        return self._sites.get((testset, server))
+
+    def items(self):
+        return self._routes.items()
+
+    def lookup(self, testset, server, path):
+        route = self._routes.get((testset, server, path))
+        if route is None and '//' in path:
+            route = self._routes.get((testset, server, re.sub('/+', '/', path)))
+        return route
+
+    def __len__(self):
+        return len(self._routes)
+
+    def __reduce__(self):
+        # stored in fixture archives, the mapping proxies can't be pickled
+        return RouteTable, (dict(self._routes), self._testsets, self._servers, dict(self._sites))
+
+
+class BodyCache:
+    """LRU cache of rendered fixture bodies, bounded by the total number of bytes held"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            content = self._entries.get(key)
+            if content is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(key)
+            return content
+
+    def put(self, key, content):
+        if len(content) > self.max_bytes:
+            return
+
+        with self._lock:
+            old_content = self._entries.pop(key, None)
+            if old_content is not None:
+                self.size -= len(old_content)
+
+            self._entries[key] = content
+            self.size += len(content)
+
+            while self.size > self.max_bytes:
+                evicted_key, evicted_content = self._entries.popitem(last=False)
+                self.size -= len(evicted_content)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self.size, 'max_bytes': self.max_bytes,
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+# connection is (client address, client port, time it was opened), shared by the requests of a kept alive
+# connection. connection_closed is None while it is open
+ServedRecord = collections.namedtuple('ServedRecord', ['url', 'timestamp', 'status', 'bytes_sent', 'latency',
+                                                     'client_address', 'bytes_saved', 'connection',
+                                                     'connection_closed'],
+                                      defaults=(None, None))
+
+
+class ServedUrlLedger:
+    """Served urls in request order, with a hash index for membership tests.
+
+    Per-request details are kept in typed arrays and urls/client addresses are interned, so a crawl of millions
+    of urls stays compact. A request is recorded with begin() when it arrives and completed with finish() once
+    the response has been sent. Connections are interned the same way, connection_closed() completes them."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._reset()
+
+    def _reset(self):
+        self._url_ids = {}
+        self._urls = []
+        self._client_ids = {}
+        self._clients = []
+        self._connection_ids = {}
+        self._connections = []
+        self._url = array.array('L')
+        self._client = array.array('L')
+        self._connection = array.array('L')
+        self._timestamp = array.array('d')
+        self._status = array.array('H')
+        self._bytes_sent = array.array('Q')
+        self._latency = array.array('d')
+        # body bytes not sent thanks to a 304 or a 206 response
+        self._bytes_saved = array.array('Q')
+        # per connection, 0 while it is open
+        self._connection_closed = array.array('d')
+
+    @staticmethod
+    def _intern(value, ids, values):
+        value_id = ids.get(value)
+        if value_id is None:
+            value_id = len(values)
+            ids[value] = value_id
+            values.append(value)
+        return value_id
+
+    def begin(self, url, client_address=None, timestamp=None, connection=None):
+        with self._lock:
+            self._url.append(self._intern(url, self._url_ids, self._urls))
+            self._client.append(self._intern(client_address, self._client_ids, self._clients))
+            connection_id = self._intern(connection, self._connection_ids, self._connections)
+            if connection_id == len(self._connection_closed):
+                self._connection_closed.append(0.0)
+            self._connection.append(connection_id)
+            self._timestamp.append(time.time() if timestamp is None else timestamp)
+            self._status.append(0)
+            self._bytes_sent.append(0)
+            self._latency.append(0.0)
+            self._bytes_saved.append(0)
+            return self._generation, len(self._url) - 1
+
+    def finish(self, record_id, status, bytes_sent, latency, bytes_saved=0):
+        generation, index = record_id
+        with self._lock:
+            # the ledger may have been cleared while the request was in flight
+            if generation != self._generation:
+                return
+            self._status[index] = status
+            self._bytes_sent[index] = bytes_sent
+            self._latency[index] = latency
+            self._bytes_saved[index] = bytes_saved
+
+    def connection_closed(self, connection, timestamp):
+        """Record when a connection closed, ignored for connections without requests in this ledger"""
+        with self._lock:
+            connection_id = self._connection_ids.get(connection)
+            if connection_id is not None:
+                self._connection_closed[connection_id] = timestamp
+
+    def add(self, url, client_address=None, timestamp=None, status=0, bytes_sent=0, latency=0.0, bytes_saved=0,
+            connection=None, connection_closed=None):
+        self.finish(self.begin(url, client_address, timestamp, connection), status, bytes_sent, latency,
+                    bytes_saved)
+        if connection_closed is not None:
+            self.connection_closed(connection, connection_closed)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._reset()
+
+    def snapshot(self):
+        """Return an independent copy, unaffected by requests served afterwards"""
+        snapshot = ServedUrlLedger()
+        with self._lock:
+            snapshot._url_ids = dict(self._url_ids)
+            snapshot._urls = list(self._urls)
+            snapshot._client_ids = dict(self._client_ids)
+            snapshot._clients = list(self._clients)
+            snapshot._connection_ids = dict(self._connection_ids)
+            snapshot._connections = list(self._connections)
+            for name in ('_url', '_client', '_connection', '_timestamp', '_status', '_bytes_sent', '_latency',
+                         '_bytes_saved', '_connection_closed'):
+                setattr(snapshot, name, array.array(getattr(self, name).typecode, getattr(self, name)))
+        return snapshot
+
+    def __contains__(self, url):
+        return url in self._url_ids
+
+    def __len__(self):
+        return len(self._url)
+
+    def __iter__(self):
+        urls = self._urls
+        return (urls[url_id] for url_id in self._url[:len(self._url)])
+
+    def records(self):
+        for i in range(len(self._url)):
+            connection_id = self._connection[i]
+            yield ServedRecord(self._urls[self._url[i]], self._timestamp[i], self._status[i], self._bytes_sent[i],
+                               self._latency[i], self._clients[self._client[i]], self._bytes_saved[i],
+                               self._connections[connection_id], self._connection_closed[connection_id] or None)
+
+
+def create_ssl_context(certfile, keyfile):
+    ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    ctx.load_cert_chain(certfile, keyfile)
+    # stateless resumption; the server side session cache (TLS 1.2 session ids) is enabled by default
+    ctx.options &= ~ssl.OP_NO_TICKET
+    if hasattr(ctx, 'num_tickets'):
+        ctx.num_tickets = 2
+    return ctx
+
+
+class CertificateStore:
+    """SSL contexts per testset, loaded on first use from <certdir>/<testset>.cert and <certdir>/<testset>.key"""
+
+    def __init__(self, certdir):
+        self.certdir = certdir
+        self._contexts = {}
+        self._lock = threading.Lock()
+
+    def context_for(self, server_name):
+        """Return the context for the testset in server_name (<server>.<testset>...), None to keep the default"""
+        host_parts = server_name.split('.')
+        if self.certdir is None or len(host_parts) < 2:
+            return None
+
+        testset = host_parts[1]
+        with self._lock:
+            if testset not in self._contexts:
+                certfile = os.path.join(self.certdir, testset + '.cert')
+                keyfile = os.path.join(self.certdir, testset + '.key')
+                ctx = None
+                if os.path.exists(certfile) and os.path.exists(keyfile):
+                    ctx = create_ssl_context(certfile, keyfile)
+                self._contexts[testset] = ctx
+
+            return self._contexts[testset]
+
+
+class TlsStats:
+    """Handshake counters for the HTTPS listener"""
+
+    def __init__(self):
+        self.handshakes = 0
+        self.resumed = 0
+        self.handshake_time = 0.0
+        self.max_handshake_time = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, latency, resumed):
+        with self._lock:
+            self.handshakes += 1
+            if resumed:
+                self.resumed += 1
+            self.handshake_time += latency
+            self.max_handshake_time = max(self.max_handshake_time, latency)
+
+    def stats(self):
+        with self._lock:
+            return {'handshakes': self.handshakes,
+                    'resumed': self.resumed,
+                    'handshake_time': self.handshake_time,
+                    'max_handshake_time': self.max_handshake_time}
+
+
+class DirectoryListings:
+    """Sorted entries of fixture directories as shown on index pages, re-read when a directory's mtime changes"""
+
+    def __init__(self):
+        self._listings = {}
+        self._lock = threading.Lock()
+
+    def get(self, dir):
+        """Return (mtime_ns, entries) for dir"""
+        mtime = os.stat(dir).st_mtime_ns
+        with self._lock:
+            listing = self._listings.get(dir)
+        if listing is not None and listing[0] == mtime:
+            return listing
+
+        names = DirectorySettings(dir, os.listdir(dir)).names()
+        entries = sorted(f for f in names if os.path.splitext(f)[1] not in HIDDEN_ENDINGS and f not in HIDDEN_FILES)
+
+        listing = (mtime, entries)
+        with self._lock:
+            self._listings[dir] = listing
+        return listing
+
+
+# os.stat_result look-alike for files in a fixture archive
+PackedStat = collections.namedtuple('PackedStat', ['st_size', 'st_mtime_ns', 'st_mtime'])
+
+
+class FixtureFiles:
+    """Fixtures read from the test directory, so edited bodies are served without a reload"""
+
+    # bodies have to be read, they are worth keeping in the body cache
+    mapped = False
+
+    def __init__(self, root):
+        self.root = root
+        self.listings = DirectoryListings()
+
+    def build_routes(self):
+        return RouteTable.build(self.root)
+
+    def stat(self, path):
+        return os.stat(path)
+
+    def read(self, path):
+        with open(path, "rb") as f:
+            return f.read()
+
+    def read_range(self, path, start, end):
+        return read_file_range(path, start, end)
+
+    def template(self, path, charset):
+        return Template.compile(self.read(path), charset)
+
+    def listing(self, dir):
+        return self.listings.get(dir)
+
+
+class PackedFixtures:
+    """Fixtures served from a mapped archive built by fixturepack. Bodies and templates are slices of the
+    mapping, so serving a request doesn't touch the filesystem"""
+
+    mapped = True
+
+    def __init__(self, path):
+        self.pack = fixturepack.FixturePack(path)
+        self.files = self.pack.index['files']
+        self.listings = self.pack.index['listings']
+
+    def build_routes(self):
+        return self.pack.index['routes']
+
+    def entry(self, path):
+        entry = self.files.get(os.path.normpath(path))
+        if entry is None:
+            raise FileNotFoundError(errno.ENOENT, 'Not in fixture archive', path)
+        return entry
+
+    def stat(self, path):
+        entry = self.entry(path)
+        return PackedStat(entry.size, entry.mtime_ns, entry.mtime_ns / 1e9)
+
+    def read(self, path):
+        entry = self.entry(path)
+        return self.pack.blob(entry.offset, entry.size)
+
+    def read_range(self, path, start, end):
+        return (self.read(path)[start:end],)
+
+    def template(self, path, charset):
+        entry = self.entry(path)
+        if entry.template is None or entry.template[0] != charset:
+            return Template.compile(bytes(self.read(path)), charset)
+
+        segments = entry.template[1]
+        return Template([segment if i % 2 else self.pack.blob(*segment) for i, segment in enumerate(segments)],
+                        charset)
+
+    def listing(self, dir):
+        listing = self.listings.get(os.path.normpath(dir))
+        if listing is None:
+            raise FileNotFoundError(errno.ENOENT, 'Not in fixture archive', dir)
+        return listing
+
+
+def pack_template(writer, template, content, offset):
+    """Archive form of a compiled template. Literals found where they are in the body (any ASCII compatible
+    charset) point into it, the others are written to the archive"""
+    segments = []
+    pos = 0
+    for i, segment in enumerate(template.segments):
+        if i % 2:
+            segments.append(segment)
+            pos += len(('{%s}' % segment).encode(template.charset))
+            continue
+
+        if content[pos:pos + len(segment)] == segment:
+            segments.append((offset + pos, len(segment)))
+        else:
+            segments.append((writer.add(segment), len(segment)))
+        pos += len(segment)
+
+    return template.charset, segments
+
+
+def pack_fixtures(root, path):
+    """Compile the fixture tree under root into an archive at path. Returns the number of files packed"""
+    init_mimetypes()
+    routes = RouteTable.build(root)
+    listings = DirectoryListings()
+    writer = fixturepack.PackWriter(path)
+
+    files = {}
+    dir_listings = {}
+    for key, route in routes.items():
+        file_path = os.path.normpath(route.file_path)
+        if route.kind == ROUTE_INDEX:
+            dir_listings[file_path] = listings.get(route.file_path)
+        if route.kind != ROUTE_FILE or file_path in files:
+            continue
+
+        try:
+            st = os.stat(route.file_path)
+            with open(route.file_path, "rb") as f:
+                content = f.read()
+        except OSError:
+            # a .generate recipe without the file it describes
+            continue
+
+        offset = writer.add(content)
+        template = None
+        if is_templated(route.content_type, route.content_encoding):
+            try:
+                template = pack_template(writer, Template.compile(content, route.charset or 'utf-8'), content, offset)
+            except (UnicodeError, LookupError):
+                # left to fail at request time, as it does when served from the directory
+                pass
+        files[file_path] = fixturepack.FileEntry(offset, st.st_size, st.st_mtime_ns, template)
+
+    writer.close({'routes': routes, 'files': files, 'listings': dir_listings})
+    return len(files)
+
+
+def render_index_page(dir, path, entries, page=None, page_size=0):
+    """Index page linking entries, or only the entries of page (1 based) with links to its neighbours"""
+    content = ['<html>', '<head>', '<meta charset="UTF-8"/>', '	<title>Contents of %s</title>' % dir, '</head>',
+               '<body>']
+
+    total = len(entries)
+    if page is not None:
+        first = (page - 1) * page_size
+        entries = entries[first:first + page_size]
+
+    filedir = "" if (path == "/") else path
+    for f in entries:
+        content.append('<p><a href="%s/%s">%s</a></p>' % (filedir, html.escape(f), html.escape(f)))
+
+    if page is not None:
+        if page > 1:
+            content.append('<p><a href="?page=%d">previous</a></p>' % (page - 1))
+        if first + page_size < total:
+            content.append('<p><a href="?page=%d">next</a></p>' % (page + 1))
+
+    content.append('</body>')
+    content.append('</html>')
+    return ''.join(content)
+
+
+class ServerMetrics:
+    """Request counters for the stats endpoint, cheap enough to update on every request"""
+
+    def __init__(self):
+        self.started = time.time()
+        self.requests = 0
+        self.bytes_sent = 0
+        self.bytes_saved = 0
+        self.in_flight = 0
+        self.status_codes = collections.Counter()
+        # testset -> server -> [count, latency sum, histogram]
+        self.latencies = {}
+        self._rate_seconds = [0] * RATE_WINDOW
+        self._rate_counts = [0] * RATE_WINDOW
+        self._lock = threading.Lock()
+
+    def connection_opened(self):
+        with self._lock:
+            self.in_flight += 1
+
+    def connection_closed(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def record(self, testset, server, status, bytes_sent, latency, bytes_saved=0):
+        second = int(time.monotonic())
+        slot = second % RATE_WINDOW
+        with self._lock:
+            self.requests += 1
+            self.bytes_sent += bytes_sent
+            self.bytes_saved += bytes_saved
+            self.status_codes[status] += 1
+
+            if self._rate_seconds[slot] != second:
+                self._rate_seconds[slot] = second
+                self._rate_counts[slot] = 0
+            self._rate_counts[slot] += 1
+
+            if testset is not None:
+                latencies = self.latencies.setdefault(testset, {}).get(server)
+                if latencies is None:
+                    latencies = self.latencies[testset][server] = [0, 0.0, [0] * (len(LATENCY_BUCKETS) + 1)]
+                latencies[0] += 1
+                latencies[1] += latency
+                latencies[2][bisect.bisect_left(LATENCY_BUCKETS, latency)] += 1
+
+    def stats(self):
+        # the current second is still filling up, so the rate is taken over the seconds before it
+        now = int(time.monotonic())
+        with self._lock:
+            recent = sum(count for second, count in zip(self._rate_seconds, self._rate_counts)
+                         if now - RATE_WINDOW <= second < now)
+            return {'uptime': time.time() - self.started,
+                    'requests': self.requests,
+                    'requests_per_second': recent / RATE_WINDOW,
+                    'in_flight': self.in_flight,
+                    'bytes_sent': self.bytes_sent,
+                    'bytes_saved': self.bytes_saved,
+                    'status_codes': {str(status): count for status, count in self.status_codes.items()},
+                    'latency': {testset: {server: {'count': latencies[0], 'sum': latencies[1],
+                                                   'histogram': list(latencies[2])}
+                                          for server, latencies in servers.items()}
+                                for testset, servers in self.latencies.items()}}
+
+
+def merge_metrics(all_stats):
+    """Combine ServerMetrics.stats() of several processes"""
+    merged = {'uptime': 0.0, 'requests': 0, 'requests_per_second': 0.0, 'in_flight': 0, 'bytes_sent': 0,
+              'bytes_saved': 0, 'status_codes': collections.Counter(), 'latency': {}}
+    for stats in all_stats:
+        merged['uptime'] = max(merged['uptime'], stats['uptime'])
+        for name in ('requests', 'requests_per_second', 'in_flight', 'bytes_sent', 'bytes_saved'):
+            merged[name] += stats[name]
+        merged['status_codes'].update(stats['status_codes'])
+
+        for testset, servers in stats['latency'].items():
+            for server, latencies in servers.items():
+                merged_latencies = merged['latency'].setdefault(testset, {}).get(server)
+                if merged_latencies is None:
+                    merged['latency'][testset][server] = latencies
+                else:
+                    merged_latencies['count'] += latencies['count']
+                    merged_latencies['sum'] += latencies['sum']
+                    merged_latencies['histogram'] = [a + b for a, b in zip(merged_latencies['histogram'],
+                                                                           latencies['histogram'])]
+
+    merged['status_codes'] = dict(merged['status_codes'])
+    return merged
+
+
+class JsonlFormatter(logging.Formatter):
+    """One compact JSON object per line from the access fields of a record"""
+
+    def format(self, record):
+        fields = dict(ts=round(record.created, 3), **record.access)
+        return json.dumps(fields, separators=(',', ':'))
+
+
+class AccessLog:
+    """Sampled JSONL access log, one line for every sampled request"""
+
+    def __init__(self, path, sample=1.0):
+        self.sample = sample
+        self.handler = logging.FileHandler(path)
+        self.handler.setFormatter(JsonlFormatter())
+        # a logger of its own, outside the logging hierarchy, so another webserver in the process doesn't share it
+        # and fileConfig doesn't disable it
+        self.logger = logging.Logger(__name__ + '.access', logging.INFO)
+        self.logger.propagate = False
+        self.logger.addHandler(self.handler)
+
+    def close(self):
+        self.logger.removeHandler(self.handler)
+        self.handler.close()
+
+    def log(self, client, method, url, status, bytes_sent, latency):
+        if self.sample < 1 and random.random() >= self.sample:
+            return
+
+        self.logger.info('access', extra={'access': {'client': client, 'method': method, 'url': url,
+                                                     'status': status, 'bytes': bytes_sent,
+                                                     'latency': round(latency, 6)}})
+
+
+class RecordQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler enqueueing records as they are. The stock one merges msg % args and formats the record before
+    enqueueing it, so it can be pickled. This queue never leaves the process, which leaves all formatting to the
+    handlers on the listener thread"""
+
+    def prepare(self, record):
+        return record
+
+
+class ParentLogHandler(logging.handlers.QueueHandler):
+    """Handler of a forked worker sending its log records to the parent, so only the parent writes the log files
+    and a RotatingFileHandler isn't rotated by every worker on its own. The stock prepare formats the records so
+    they can be pickled"""
+
+    def __init__(self, server):
+        logging.handlers.QueueHandler.__init__(self, None)
+        self.server = server
+
+    def enqueue(self, record):
+        self.server.send_to_parent(('log', record))
+
+
+def start_log_queue(log, handlers):
+    """Replace the handlers of log by a queue, drained into handlers by a background thread.
+    Returns the started QueueListener"""
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    for handler in log.handlers[:]:
+        log.removeHandler(handler)
+    log.addHandler(RecordQueueHandler(log_queue))
+    listener.start()
+    return listener
+
+
+def stop_log_queue(log, listener):
+    """Undo start_log_queue: stop listener once it has written out the queue and give log its handlers back"""
+    listener.stop()
+    for handler in log.handlers[:]:
+        if isinstance(handler, RecordQueueHandler) and handler.queue is listener.queue:
+            log.removeHandler(handler)
+    for handler in listener.handlers:
+        log.addHandler(handler)
+
+
+class CountingWriter:
+    """Write-through wrapper counting the bytes written to a stream"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.bytes_written = 0
+
+    def write(self, data):
+        self.bytes_written += len(data)
+        return self.stream.write(data)
+
+    def flush(self):
+        self.stream.flush()
+
+    def close(self):
+        self.stream.close()
+
+    @property
+    def closed(self):
+        return self.stream.closed
+
+
 def init_mimetypes():
     mimetypes.init()
     mimetypes.add_type('text/x-csrc', '.c')
@@ -36,33 +1343,275 @@ def init_mimetypes():
     mimetypes.add_type('text/x-c++src', '.hpp')
 
 
-class Handler(BaseHTTPRequestHandler):
-    def log_message(self, format, *args):
-        logger.info("%s" % (format % args))
+# response to a fixture request. body is an iterable of bytes-like chunks, already framed when the response is
+# chunked, unless sendfile gives the (path, offset, size) of a body to copy straight from a file.
+# pacing is (write size, rate, chunk delay) for a body sent in timed writes, write size 0 keeping the body's own
+# chunks, with the header block going out in the first write when pace_headers is set. delay is the seconds to
+# wait before responding, reset asks for the connection to be reset instead and close for it not to be reused
+Response = collections.namedtuple('Response', ['status', 'headers', 'body', 'sendfile', 'pacing', 'pace_headers',
+                                               'close', 'delay', 'reset', 'bytes_saved'],
+                                  defaults=((), (), None, None, False, False, 0, False, 0))
+
+
+def has_body(status):
+    """1xx, 204 and 304 responses end with their header block, whatever the fixture holds"""
+    return status >= 200 and status not in (204, 304)
+
+
+def page_response(status, headers, content):
+    """Response with its whole body at hand"""
+    if not has_body(status):
+        return Response(status, headers, ())
+    return Response(status, headers + [("Content-Length", str(len(content)))], (content,))
+
+
+def html_response(status, message):
+    return page_response(status, [("Content-type", "text/html")],
+                         ('<html><body>%s</body></html>' % message).encode())
+
+
+def not_found_response(path):
+    return html_response(404, '404 - %s was not found' % path)
+
+
+def request_headers(headers):
+    """Case insensitive header lookup for a dict of request headers, a parsed message is used as it is"""
+    if headers is None or isinstance(headers, email.message.Message):
+        return headers if headers is not None else http.client.HTTPMessage()
+
+    message = http.client.HTTPMessage()
+    for name, value in headers.items():
+        message[name] = value
+    return message
+
+
+class FixtureRequest:
+    """A GET of path (with its query) on host, resolved against the fixtures of webserver into a Response without
+    any connection. webserver is a TestWebServer or a FixtureResolver, anything with their fixtures, routes,
+    body_cache, negotiate_encoding and index_page_size"""
+
+    def __init__(self, webserver, scheme, port, host, path, headers=None, request_version='HTTP/1.1'):
+        self.webserver = webserver
+        self.scheme = scheme
+        self.port = port
+        # strip of port from host (eg. www.example.com:80
+        self.host = host.split(':')[0]
+        self.path = path
+        self.headers = request_headers(headers)
+        self.request_version = request_version
+        self.query = {}
+
+        # Host is expected to be in the form of <server>.<testcase>.something.....
+        self.server = self.testset = self.domain = None
+        host_parts = self.host.split('.')
+        if len(host_parts) >= 2:
+            self.server = host_parts[0]
+            self.testset = host_parts[1]
+            self.domain = ".".join(host_parts[2:len(host_parts)])
+
+    def resolve(self):
+        if self.testset is None:
+            return html_response(500, 'Host %s is unknown' % self.host)
+
+        parsed_url = urlparse.urlparse(self.path)
+        self.query = urlparse.parse_qs(parsed_url.query)
+
+        logger.debug("testset=%s, server=%s, path=%s", self.testset, self.server, parsed_url.path)
+        return self.resolve_page(self.testset, self.server, parsed_url.path)
+
+    def resolve_page(self, testset, server, path):
+        path = unescape_path(path)
+
+        routes = self.webserver.routes
+        if not routes.has_testset(testset):
+            return html_response(500, 'testset %s is unknown' % testset)
+
+        if not routes.has_server(testset, server):
+            return html_response(500, 'server %s is unknown' % server)
+
+        # ok, testset and server is known
+        site = routes.site(testset, server)
+        if site is not None:
+            return self.resolve_site_page(site, path)
+
+        route = routes.lookup(testset, server, path)
+        if route is None:
+            return not_found_response(root_dir + "/" + testset + "/" + server + path)
+
+        if route.kind == ROUTE_INDEX:
+            return self.resolve_index_page(route, root_dir + "/" + testset + "/" + server + path, path)
+
+        if route.kind == ROUTE_NOINDEX:
+            return page_response(404, [], b'')
+
+        if route.kind == ROUTE_RESET:
+            return Response(0, reset=True)
+
+        return self.resolve_file(route)
+
+    def resolve_file(self, route):
+        base_path = route.file_path
+        status_code = route.status_code
+        content_type = route.content_type
+        charset = route.charset
+        content_encoding = route.content_encoding
+        extra_headers = [fill_placeholders(h, self.scheme, self.domain, self.port) for h in route.extra_headers]
+
+        type_header = content_type
+        if content_type is not None and charset is not None:
+            type_header = content_type + "; charset=" + charset
+
+        # encoding is the compression applied here, either forced by the fixture or negotiated with the client
+        encoding = None
+        vary = False
+        if content_encoding == 'gzip':
+            encoding = 'gzip'
+        elif content_encoding is None and route.generate is None and self.should_negotiate(route, content_type):
+            encoding = negotiate_encoding(self.headers.get("Accept-Encoding"))
+            vary = True
+
+        has_content_length = any(h.split(":")[0].strip().lower() == 'content-length'
+                                 for h in extra_headers if ':' in h)
+        # fixture dictates its own (possibly bogus) framing, so the connection can't be reused
+        response = Response(status_code, delay=route.connection_delay, close=has_content_length)
+
+        # only plain responses of fixture files have validators and can be served partially
+        etag = last_modified = None
+        ranges = None
+        boundary = None
+        if status_code == 200 and route.generate is None:
+            etag, last_modified = self.fixture_validators(route, encoding)
+            if self.is_not_modified(etag, last_modified):
+                return self.resolve_not_modified(response, route, encoding, etag, last_modified, vary)
+
+        accept_ranges = (status_code == 200 and route.generate is None and route.accept_ranges and
+                         route.chunked is None and not is_paced(route) and not has_content_length)
+        if accept_ranges and "Range" in self.headers and self.is_range_current(etag, last_modified):
+            length = self.representation_length(route, encoding)
+            ranges = parse_range(self.headers["Range"], length)
+            if ranges == []:
+                return page_response(416, [("Content-Range", "bytes */%d" % length)], b'')._replace(
+                    delay=response.delay)
+            if ranges is not None and len(ranges) > 1:
+                boundary = '%016x' % random.getrandbits(64)
+
+        # ok, got it all
+        headers = []
+        if boundary is not None:
+            headers.append(("Content-type", "multipart/byteranges; boundary=" + boundary))
+        elif type_header is not None:
+            headers.append(("Content-type", type_header))
+
+        if vary:
+            headers.append(("Vary", "Accept-Encoding"))
+
+        if content_encoding:
+            headers.append(("Content-Encoding", content_encoding))
+        elif encoding:
+            headers.append(("Content-Encoding", encoding))
+
+        headers.extend(validator_headers(etag, last_modified))
+        if accept_ranges:
+            headers.append(("Accept-Ranges", "bytes"))
 
-    def file_content(self, path, content_type=None, content_encoding=None, charset=None):
-        """Return content of file. Empty string for non-existing files"""
-        if not os.path.isfile(path):
+        for h in extra_headers:
+            if ':' in h:
+                headers.append((h.split(":")[0], h.partition(":")[2]))
+
+        response = response._replace(status=206 if ranges else status_code, headers=headers)
+        if not has_body(status_code):
+            # on a kept alive connection the client would read the body as the next response
+            return response._replace(body=())
+
+        if route.chunked is not None:
+            return self.resolve_chunked(response, route, self.chunked_source(route, encoding))
+
+        if route.generate is not None:
+            return self.resolve_generated(response, route)
+
+        if ranges:
+            return self.resolve_ranges(response, route, encoding, ranges, length, boundary, type_header)
+
+        if not is_paced(route) and encoding is None and not is_templated(content_type, content_encoding):
+            # static content, let the kernel copy it straight from the file to the socket
+            try:
+                size = self.webserver.fixtures.stat(base_path).st_size
+            except OSError:
+                size = 0
+
+            if not has_content_length:
+                headers.append(("Content-Length", str(size)))
+            return self.fixture_body(response, base_path, size)
+
+        if not is_paced(route) and encoding is None:
+            # templated text, streamed from the compiled segments without rendering the whole body first
+            template = self.file_template(base_path, charset)
+            values = self.template_values(template)
+            if not has_content_length:
+                headers.append(("Content-Length", str(template.length(values))))
+            return response._replace(body=template.chunks(values))
+
+        content = self.file_content(base_path, content_type, content_encoding, charset, encoding)
+        if not has_content_length:
+            headers.append(("Content-Length", str(len(content))))
+
+        response = response._replace(body=(content,))
+        if is_paced(route):
+            # the headers are part of the paced stream, so the first chunk carries them like a real packet would
+            response = response._replace(pacing=(paced_chunk_size(route), route.content_rate,
+                                                 route.content_chunk_delay), pace_headers=True)
+        return response
+
+    def fixture_body(self, response, path, size, offset=0):
+        """response with size bytes of a fixture file from offset as its body, straight from the mapping when the
+        fixtures are packed"""
+        fixtures = self.webserver.fixtures
+        if fixtures.mapped:
+            return response._replace(body=(fixtures.read(path)[offset:offset + size],) if size > 0 else ())
+        if size == 0:
+            return response._replace(body=())
+        return response._replace(sendfile=(path, offset, size))
+
+    def file_content(self, path, content_type=None, content_encoding=None, charset=None, encoding=None):
+        """Return content of file, compressed with encoding if given. Empty string for non-existing files"""
+        fixtures = self.webserver.fixtures
+        try:
+            mtime = fixtures.stat(path).st_mtime_ns
+        except OSError:
             return bytes()
 
         if charset is None:
             charset = 'utf-8'
 
-        if content_type is None:
-            content_type = 'text/plain'
+        templated = is_templated(content_type, content_encoding)
+        if templated:
+            cache_key = (path, mtime, self.scheme, self.domain, self.port, charset)
+        else:
+            cache_key = (path, mtime, None, None, None, None)
 
-        content = bytes()
-        try:
-            with open(path, "rb") as f:
-                if self.server == self.server.webserver.http_server_thread.server:
-                    scheme = "http"
-                else:
-                    scheme = "https"
+        body_cache = self.webserver.body_cache
+        if encoding is not None:
+            variant_key = cache_key + (encoding,)
+            content = body_cache.get(variant_key)
+            if content is None:
+                content = compress(self.file_content(path, content_type, content_encoding, charset), encoding)
+                body_cache.put(variant_key, content)
+            return content
 
-                content = f.read()
-                if content_type.startswith('text/') and content_encoding is None:
-                    content = content.decode(charset).format(SCHEME=scheme, DOMAIN=self.domain, PORT=self.server.server_port).encode(charset)
+        if templated:
+            template = self.file_template(path, charset)
+            return template.render(self.template_values(template))
 
+        content = body_cache.get(cache_key)
+        if content is not None:
+            return content
+
+        content = bytes()
+        try:
+            content = fixtures.read(path)
+            # a mapped archive already holds the body in memory
+            if not fixtures.mapped:
+                body_cache.put(cache_key, content)
         except IOError:
             pass
 
@@ -71,293 +1620,1297 @@ class Handler(BaseHTTPRequestHandler):
 
         return content
 
+    def file_template(self, path, charset=None):
+        """Return the compiled Template of a text file. Empty for non-existing files"""
+        if charset is None:
+            charset = 'utf-8'
+
+        fixtures = self.webserver.fixtures
+        try:
+            mtime = fixtures.stat(path).st_mtime_ns
+        except OSError:
+            return Template([b''], charset)
+
+        # compiled templates don't depend on the request, so there's one per file for all hosts
+        cache_key = (path, mtime, 'template', charset)
+        body_cache = self.webserver.body_cache
+        template = body_cache.get(cache_key)
+        if template is None:
+            try:
+                template = fixtures.template(path, charset)
+            except IOError:
+                return Template([b''], charset)
+            body_cache.put(cache_key, template)
+
+        return template
+
+    def template_values(self, template):
+        return template.encode_values(self.scheme, self.domain, self.port)
+
+    def fixture_validators(self, route, encoding):
+        """Return the (ETag, Last-Modified) header values of a file route, from its sidecars or generated from
+        the file. None for those left out"""
+        try:
+            st = self.webserver.fixtures.stat(route.file_path)
+        except OSError:
+            st = None
+
+        etag = route.etag
+        if st is not None and etag in (None, ETAG_CONTENT_HASH):
+            if etag is None:
+                tag = '%x-%x' % (st.st_mtime_ns, st.st_size)
+            else:
+                tag = self.file_hash(route.file_path, st.st_mtime_ns)
+            # the body differs per host for templated text and per coding for compressed responses
+            if is_templated(route.content_type, route.content_encoding):
+                host = '%s %s %s' % (self.scheme, self.domain, self.port)
+                tag += '-%08x' % zlib.crc32(host.encode())
+            if encoding is not None:
+                tag += '-' + encoding
+            etag = '"' + tag + '"'
+        elif etag == ETAG_CONTENT_HASH:
+            etag = None
+
+        last_modified = route.last_modified
+        if last_modified is None and st is not None:
+            last_modified = email.utils.formatdate(st.st_mtime, usegmt=True)
+
+        return etag or None, last_modified or None
+
+    def file_hash(self, path, mtime):
+        """Hex crc32 of a file's content, kept in the body cache as long as the file is unchanged"""
+        cache_key = (path, mtime, 'hash')
+        body_cache = self.webserver.body_cache
+        digest = body_cache.get(cache_key)
+        if digest is None:
+            crc = 0
+            fixtures = self.webserver.fixtures
+            try:
+                for chunk in fixtures.read_range(path, 0, fixtures.stat(path).st_size):
+                    crc = zlib.crc32(chunk, crc)
+            except IOError:
+                pass
+            digest = '%08x' % crc
+            body_cache.put(cache_key, digest)
+        return digest
+
+    def is_not_modified(self, etag, last_modified):
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match is not None:
+            # If-Modified-Since is ignored when both are sent
+            return etag is not None and etag_matches(if_none_match, etag)
+
+        if_modified_since = self.headers.get("If-Modified-Since")
+        if if_modified_since is None or last_modified is None:
+            return False
+        since = parse_http_date(if_modified_since)
+        modified = parse_http_date(last_modified)
+        return since is not None and modified is not None and modified <= since
+
+    def is_range_current(self, etag, last_modified):
+        """Whether the If-Range condition holds, so the Range header is to be honoured"""
+        if_range = self.headers.get("If-Range")
+        if if_range is None:
+            return True
+        if_range = if_range.strip()
+        if if_range.startswith(('"', 'W/"')):
+            return etag is not None and etag_matches(if_range, etag, weak=False)
+        return last_modified is not None and if_range == last_modified
+
+    def representation_length(self, route, encoding):
+        """Length of the full body of a file route"""
+        if encoding is None and not is_templated(route.content_type, route.content_encoding):
+            try:
+                return self.webserver.fixtures.stat(route.file_path).st_size
+            except OSError:
+                return 0
+
+        if encoding is None:
+            template = self.file_template(route.file_path, route.charset)
+            return template.length(self.template_values(template))
+
+        return len(self.file_content(route.file_path, route.content_type, route.content_encoding, route.charset,
+                                     encoding))
+
+    def resolve_not_modified(self, response, route, encoding, etag, last_modified, vary):
+        headers = validator_headers(etag, last_modified)
+        if vary:
+            headers.append(("Vary", "Accept-Encoding"))
+        return Response(304, headers, (), delay=response.delay,
+                        bytes_saved=self.representation_length(route, encoding))
+
+    def resolve_ranges(self, response, route, encoding, ranges, length, boundary, content_type):
+        """response with ranges of the body of a file route, as a multipart/byteranges body when there are
+        several"""
+        if encoding is None and not is_templated(route.content_type, route.content_encoding):
+            static = True
+            read = functools.partial(self.webserver.fixtures.read_range, route.file_path)
+        else:
+            static = False
+            content = memoryview(self.file_content(route.file_path, route.content_type, route.content_encoding,
+                                                   route.charset, encoding))
+            read = lambda start, end: (content[start:end],)
+
+        response = response._replace(bytes_saved=max(0, length - sum(end - start for start, end in ranges)))
+
+        if boundary is None:
+            start, end = ranges[0]
+            response.headers.append(("Content-Range", "bytes %d-%d/%d" % (start, end - 1, length)))
+            response.headers.append(("Content-Length", str(end - start)))
+            if static:
+                return self.fixture_body(response, route.file_path, end - start, start)
+            return response._replace(body=read(start, end))
+
+        heads = byteranges_heads(boundary, content_type, ranges, length)
+        response.headers.append(("Content-Length",
+                                 str(sum(map(len, heads)) + sum(end - start for start, end in ranges))))
+        return response._replace(body=byteranges_chunks(heads, ranges, read))
+
+    def resolve_site_page(self, site, path):
+        page = site.resolve(path)
+        if page is None:
+            return not_found_response(path)
+
+        headers = []
+        if page.location is not None:
+            headers.append(("Location", page.location))
+        headers.append(("Content-type", "text/html; charset=UTF-8"))
+        return page_response(page.status_code, headers, page.content)
+
+    def should_negotiate(self, route, content_type):
+        if route.negotiate:
+            return True
+        return self.webserver.negotiate_encoding and (content_type or '').startswith(COMPRESSIBLE_TYPES)
+
+    def resolve_generated(self, response, route):
+        recipe = route.generate
+        chunks = recipe.chunks()
+        if not response.close and recipe.size is not None:
+            response.headers.append(("Content-Length", str(recipe.size)))
+        elif not response.close and self.request_version >= 'HTTP/1.1':
+            response.headers.append(("Transfer-Encoding", "chunked"))
+            chunks = frame_chunks(chunks)
+        else:
+            # HTTP/1.0 client or framing dictated by the fixture, so the body ends when the connection does
+            response = response._replace(close=True)
+
+        response = response._replace(body=chunks)
+        if is_paced(route):
+            response = response._replace(pacing=(paced_chunk_size(route), route.content_rate,
+                                                 route.content_chunk_delay))
+        return response
+
+    def chunked_source(self, route, encoding):
+        """Body of a chunked route as it's read or generated, before it's cut into the route's chunk layout"""
+        if route.generate is not None:
+            return route.generate.chunks()
+
+        base_path = route.file_path
+        if encoding is None and not is_templated(route.content_type, route.content_encoding):
+            fixtures = self.webserver.fixtures
+            try:
+                size = fixtures.stat(base_path).st_size
+            except OSError:
+                return ()
+            return fixtures.read_range(base_path, 0, size)
+
+        if encoding is None:
+            template = self.file_template(base_path, route.charset)
+            return template.chunks(self.template_values(template))
+
+        # compressed bodies are only chunked once the whole body is compressed
+        return (self.file_content(base_path, route.content_type, route.content_encoding, route.charset, encoding),)
+
+    def resolve_chunked(self, response, route, chunks):
+        """response with chunks sent with Transfer-Encoding: chunked, cut into the route's chunk layout and
+        followed by its trailer fields. Pacing applies per chunk, content-mtu splits chunks further into
+        separate writes"""
+        chunks = layout_chunks(chunks, route.chunked.chunk_sizes())
+        if self.request_version >= 'HTTP/1.1':
+            trailers = [fill_placeholders(h, self.scheme, self.domain, self.port) for h in route.chunk_trailers]
+            response.headers.append(("Transfer-Encoding", "chunked"))
+            if trailers:
+                response.headers.append(("Trailer", ", ".join(h.split(":")[0].strip() for h in trailers)))
+            chunks = frame_chunks(chunks, trailers)
+        else:
+            # HTTP/1.0 client, so the body ends when the connection does
+            response = response._replace(close=True)
+
+        response = response._replace(body=chunks)
+        if is_paced(route):
+            response = response._replace(pacing=(route.content_mtu, route.content_rate, route.content_chunk_delay))
+        return response
+
+    def resolve_index_page(self, route, dir, path):
+        """Listing of the directory of an index route. dir is the directory as it's shown, the listing is looked up
+        by the route's path, which is how an archive built from a differently spelled test directory knows it"""
+        page = None
+        if 'page' in self.query:
+            try:
+                page = int(self.query['page'][0])
+            except ValueError:
+                page = 0
+            if page < 1:
+                return not_found_response(dir + "?page=" + self.query['page'][0])
+
+        webserver = self.webserver
+        mtime, entries = webserver.fixtures.listing(route.file_path)
+        # pages past the last one don't exist, or a crawler could follow "previous" links through empty pages.
+        # An empty directory still has its first page
+        if page is not None and page > 1 and (page - 1) * webserver.index_page_size >= len(entries):
+            return not_found_response(dir + "?page=" + self.query['page'][0])
+
+        # listings only change with the directory, so a rendered page is valid as long as its mtime
+        cache_key = (dir, mtime, 'index', path, page)
+        content = webserver.body_cache.get(cache_key)
+        if content is None:
+            content = render_index_page(dir, path, entries, page, webserver.index_page_size).encode()
+            webserver.body_cache.put(cache_key, content)
+
+        return page_response(200, [("Content-type", "text/html")], content)
+
+
+def validator_headers(etag, last_modified):
+    headers = []
+    if etag is not None:
+        headers.append(("ETag", etag))
+    if last_modified is not None:
+        headers.append(("Last-Modified", last_modified))
+    return headers
+
+
+def resolve_request(webserver, scheme, port, host, path, headers=None, request_version='HTTP/1.1'):
+    """Resolve a GET into a Response without a connection, see FixtureRequest. Nothing is sent or recorded, so
+    fixtures can be resolved in-process, eg. to benchmark or verify them"""
+    return FixtureRequest(webserver, scheme, port, host, path, headers, request_version).resolve()
+
+
+class FixtureResolver:
+    """The fixtures of TestWebServer without its listeners and ledgers, for resolve_request"""
+
+    def __init__(self, pack=None, body_cache_size=64 * 1024 * 1024, negotiate_encoding=False,
+                 index_page_size=1000):
+        init_mimetypes()
+        self.fixtures = PackedFixtures(pack) if pack is not None else FixtureFiles(root_dir)
+        self.routes = self.fixtures.build_routes()
+        self.body_cache = BodyCache(body_cache_size)
+        self.negotiate_encoding = negotiate_encoding
+        self.index_page_size = index_page_size
+
+    def resolve(self, host, path, headers=None, scheme='http', port=80, request_version='HTTP/1.1'):
+        return resolve_request(self, scheme, port, host, path, headers, request_version)
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body are separate writes, with Nagle the body of a kept alive response waits for a delayed ACK
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        self.timeout = self.server.webserver.keep_alive_timeout
+        self.requests_handled = 0
+        BaseHTTPRequestHandler.setup(self)
+        self.wfile = CountingWriter(self.wfile)
+        self.server.webserver.metrics.connection_opened()
+        self.connection_key = tuple(self.client_address[:2]) + (time.time(),)
+        self.connection_recorded = False
+
+        # the listening socket defers the handshake so it is done here, off the accept loop
+        self.handshake_failed = False
+        if isinstance(self.request, ssl.SSLSocket):
+            self.handshake_failed = not self.do_handshake()
+
+    def do_handshake(self):
+        tls_stats = self.server.webserver.tls_stats
+        start = time.perf_counter()
+        try:
+            self.request.do_handshake()
+        except (ssl.SSLError, OSError) as e:
+            logger.debug("TLS handshake with %s failed: %s", self.client_address[0], e)
+            return False
+
+        tls_stats.record(time.perf_counter() - start, self.request.session_reused)
+        return True
+
+    def handle(self):
+        if not self.handshake_failed:
+            BaseHTTPRequestHandler.handle(self)
+
+    def finish(self):
+        try:
+            BaseHTTPRequestHandler.finish(self)
+        finally:
+            self.server.webserver.metrics.connection_closed()
+            if self.connection_recorded:
+                self.server.webserver.connection_closed(self.connection_key, time.time())
+
+    def log_message(self, format, *args):
+        logger.info(format, *args)
+
+    def log_request(self, code='-', size='-'):
+        # the access log has these in a better shape
+        if self.server.webserver.access_log is None:
+            BaseHTTPRequestHandler.log_request(self, code, size)
+
+    def send_response(self, code, message=None):
+        self.response_status = code
+        self.connection_header_sent = False
+        BaseHTTPRequestHandler.send_response(self, code, message)
+
+        self.requests_handled += 1
+        if self.requests_handled >= self.server.webserver.keep_alive_max_requests:
+            self.close_connection = True
+
+    def send_header(self, keyword, value):
+        if keyword.lower() == 'connection':
+            self.connection_header_sent = True
+            if value.strip().lower() == 'close':
+                self.close_connection = True
+
+        BaseHTTPRequestHandler.send_header(self, keyword, value)
+
+    def send_connection_header(self):
+        if self.connection_header_sent:
+            return
+
+        if self.close_connection:
+            self.send_header("Connection", "close")
+        elif self.request_version == 'HTTP/1.0':
+            self.send_header("Connection", "keep-alive")
+
+    def end_headers(self):
+        self.send_connection_header()
+        BaseHTTPRequestHandler.end_headers(self)
+
+    def send_body(self, content):
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(content)
+
     def do_GET(self):
+        self.request_start = time.perf_counter()
+        self.request_bytes_start = self.wfile.bytes_written
+        self.response_status = 0
+        self.ledger_record = None
+        self.bytes_saved = 0
+        self.testset = self.server_name = None
+        try:
+            self.get_page()
+        finally:
+            self.request_served()
+
+    def do_HEAD(self):
+        # the headers of the GET response, without its body
+        self.do_GET()
+
+    def request_served(self):
+        self.served(self.wfile.bytes_written - self.request_bytes_start)
+
+    def served(self, bytes_sent):
+        # control requests aren't part of the crawl, they are neither in the ledger nor in the metrics
+        if self.ledger_record is not None:
+            latency = time.perf_counter() - self.request_start
+            webserver = self.server.webserver
+            webserver.finish_served_url(self.ledger_record, self.response_status, bytes_sent, latency,
+                                        self.bytes_saved)
+            webserver.metrics.record(self.testset, self.server_name, self.response_status, bytes_sent, latency,
+                                     self.bytes_saved)
+            if webserver.access_log is not None:
+                webserver.access_log.log(self.client_address[0], self.command, self.url, self.response_status,
+                                         bytes_sent, latency)
+
+    def get_page(self):
         parsed_url = urlparse.urlparse(self.path)
         host = self.headers["Host"]
         # strip of port from host (eg. www.example.com:80
         host = host.split(':')[0]
 
-        isHttp = (self.server == self.server.webserver.http_server_thread.server)
+        self.scheme = self.server.scheme
+        isHttp = (self.scheme == "http")
 
-        if isHttp:
-            url = "http://"
-        else:
-            url = "https://"
+        if host in CONTROL_HOSTS:
+            return self.serve_control(parsed_url.path)
 
-        url += host.encode('ascii').decode('idna')
+        url = self.scheme + "://" + host.encode('ascii').decode('idna')
 
         if (isHttp and self.server.server_port != 80) or (not isHttp and self.server.server_port != 443):
             url += ':' + str(self.server.server_port)
 
         url += self.path
+        self.url = url
+
+        # requests of a tenant go to its own ledger, tenants being known by their listening port or by a label
+        # after the testset (<server>.<testset>.<tenant>.<domain>)
+        webserver = self.server.webserver
+        tenant = self.server.tenant
+        if len(host.split('.')) > 3 and host.split('.')[2] in webserver.tenants:
+            tenant = host.split('.')[2]
+
+        self.ledger_record = webserver.add_served_url(url, self.client_address[0], tenant, self.connection_key)
+        self.connection_recorded = True
+
+        request = FixtureRequest(webserver, self.scheme, self.server.server_port, host, self.path, self.headers,
+                                 self.request_version)
+        self.testset, self.server_name = request.testset, request.server
+        return self.send_resolved(request.resolve())
+
+    def serve_control(self, path):
+        webserver = self.server.webserver
+        if path == '/_stats':
+            return self.send_json(webserver.get_stats())
+        if path == '/_reload':
+            webserver.call_control('reload_routes')
+            return self.send_json({'routes': len(webserver.routes)})
+        if path == '/_tenants':
+            return self.send_json(webserver.call_control('tenant_stats'))
+
+        match = CONTROL_TENANT_RE.fullmatch(path)
+        if match is None:
+            return self.send_resolved(not_found_response(path))
+
+        tenant, action = match.groups()
+        if action == 'clear':
+            webserver.call_control('clear_served_urls', tenant)
+            return self.send_json({'tenant': tenant, 'cleared': True})
+
+        records = webserver.call_control('served_records', tenant)
+        if records is None:
+            return self.send_resolved(not_found_response(path))
+        self.send_json(records)
+
+    def send_json(self, value):
+        self.send_response(200)
+        self.send_header("Content-type", "application/json")
+        self.send_body(json.dumps(value, sort_keys=True).encode())
 
-        self.server.webserver.add_served_url(url)
-
-        # Host is expected to be in the form of <server>.<testcase>.something.....
-        if len(host.split('.')) < 2:
-            return self.respond_unknown_host(host)
-
-        host_parts = host.split('.')
-        server = host_parts[0]
-        testset = host_parts[1]
-        self.domain = ".".join(host_parts[2:len(host_parts)])
+    def send_resolved(self, response):
+        """Send a Response resolved by FixtureRequest"""
+        if response.delay > 0:
+            self.delay_response(response.delay)
 
-        path = parsed_url.path
+        if response.reset:
+            return self.respond_connection_reset()
 
-        logger.debug("testset=%s, server=%s, path=%s", testset, server, path)
-        return self.serve_page(testset, server, path)
+        self.bytes_saved = response.bytes_saved
+        self.send_response(response.status)
+        for keyword, value in response.headers:
+            self.send_header(keyword, value)
+        if response.close:
+            self.close_connection = True
 
-    def respond_unknown_host(self, host):
-        self.send_response(500)
-        self.send_header("Content-type", "text/html")
-        self.end_headers()
-        self.wfile.write(('<html><body>Host %s is unknown</body></html>' % host).encode())
+        if self.command == 'HEAD':
+            return self.end_headers()
 
-    def respond_unknown_testset(self, testset):
-        self.send_response(500)
-        self.send_header("Content-type", "text/html")
-        self.end_headers()
-        self.wfile.write(('<html><body>testset %s is unknown</body></html>' % testset).encode())
+        if response.pacing is None:
+            self.end_headers()
+            if response.sendfile is not None:
+                path, offset, size = response.sendfile
+                return self.send_file(path, size, offset)
+            return self.send_stream(response.body)
+
+        chunks = response.body
+        if response.pace_headers:
+            # the headers are part of the paced stream, so the first chunk carries them like a real packet would
+            self.send_connection_header()
+            self._headers_buffer.append(b'\r\n')
+            chunks = itertools.chain((b''.join(self._headers_buffer),), chunks)
+            self._headers_buffer = []
+        else:
+            self.end_headers()
 
-    def respond_unknown_server(self, server):
-        self.send_response(500)
-        self.send_header("Content-type", "text/html")
-        self.end_headers()
-        self.wfile.write(('<html><body>server %s is unknown</body></html>' % server).encode())
+        size, rate, chunk_delay = response.pacing
+        if size > 0:
+            chunks = split_chunks(chunks, size)
+        self.send_paced(pace_chunks(chunks, rate, chunk_delay))
 
     def respond_connection_reset(self):
         self.request.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
                                 struct.pack('ii', 1, 0))
         self.request.close()
+        self.close_connection = True
         return False
 
-    def get_default_setting(self, name, base_path, dir_path, default):
-        file_override_path = base_path + '.' + name
-        default_override_path = os.path.join(dir_path, 'default-' + name)
-
-        override_path = None
-        if os.path.exists(file_override_path):
-            override_path = file_override_path
-        elif os.path.exists(default_override_path):
-            override_path = default_override_path
-
-        value = default
-        if override_path:
-            content = self.file_content(override_path).decode().strip()
-            if type(default) is int:
-                value = int(content)
-            elif type(default) is list:
-                value = content.split('\n')
-            else:
-                value = content
+    def delay_response(self, seconds):
+        time.sleep(seconds)
 
-        return value
+    def send_stream(self, chunks):
+        try:
+            for chunk in chunks:
+                self.wfile.write(chunk)
+        except ConnectionError:
+            self.close_connection = True
 
-    def serve_page(self, testset, server, path):
-        path = unescape_path(path)
+    def send_paced(self, chunks):
+        deadline = time.monotonic()
+        try:
+            for pause, chunk in chunks:
+                deadline += pause
+                remaining = deadline - time.monotonic()
+                if remaining > 0:
+                    time.sleep(remaining)
+                self.wfile.write(chunk)
+        except ConnectionError:
+            self.close_connection = True
+
+    def send_file(self, path, size, offset=0):
+        if size == 0:
+            return
 
-        if not os.path.exists(root_dir + "/" + testset):
-            return self.respond_unknown_testset(testset)
+        # socket.sendfile falls back to a bounded send loop for SSL sockets
+        with open(path, "rb") as f:
+            self.wfile.bytes_written += self.connection.sendfile(f, offset, size)
 
-        if not os.path.exists(root_dir + "/" + testset + "/" + server):
-            return self.respond_unknown_server(server)
 
-        # ok, directory exist so testet and server is known
-        base_path = root_dir + "/" + testset + "/" + server + path
-        if os.path.isdir(base_path):
-            if os.path.exists(base_path + '/index.html'):
-                base_path = os.path.join(base_path, 'index.html')
-                path = 'index.html'
-            else:
-                return self.maybe_serve_index_page(base_path, path)
-        if not os.path.exists(base_path):
-            return self.respond_not_found(base_path)
+class AsyncHandler(Handler):
+    """Handler run against a buffered request head, recording its output for replay on an asyncio stream"""
 
-        if os.path.exists(base_path + ".connection-reset"):
-            return self.respond_connection_reset()
+    def setup(self):
+        head, self.requests_handled, self.connection_key = self.request
+        self.connection_recorded = False
+        self.rfile = io.BytesIO(head)
+        self.wfile = self
+        self.actions = []
+        self.bytes_written = 0
 
-        # Setup defaults
-        status_code = 200
-        content_type = "application/octet-stream"
-        content_encoding = None
-        content_mtu = 0
-        charset = None
-        extra_headers = []
-        connection_delay = 0
-
-        # try guessing default from mime
-        mime = mimetypes.guess_type(path, False)
-        if mime[0] is not None:
-            content_type = mime[0]
-        if content_type.startswith('text/'):
-            charset = 'UTF-8'
-
-        # look for overrides
-        dir_path = base_path
-        if not os.path.isdir(dir_path):
-            dir_path = os.path.dirname(dir_path)
-
-        status_code = self.get_default_setting('status-code', base_path, dir_path, status_code)
-        content_type = self.get_default_setting('content-type', base_path, dir_path, content_type)
-        charset = self.get_default_setting('charset', base_path, dir_path, charset)
-        content_encoding = self.get_default_setting('content-encoding', base_path, dir_path, content_encoding)
-        content_mtu = self.get_default_setting('content-mtu', base_path, dir_path, content_mtu)
-        extra_headers = self.get_default_setting('extra-headers', base_path, dir_path, extra_headers)
-        connection_delay = self.get_default_setting('connection-delay', base_path, dir_path, connection_delay)
-
-        if content_type == "":
-            content_type = None
-        if charset == "":
-            charset = None
-        if content_encoding == "":
-            content_encoding = None
-
-        if connection_delay > 0:
-            time.sleep(connection_delay)
+    def handle(self):
+        self.handle_one_request()
 
-        # ok, got it all
-        self.send_response(status_code)
+    def finish(self):
+        pass
 
-        if content_type is not None:
-            if charset is None:
-                self.send_header("Content-type", content_type)
-            else:
-                self.send_header("Content-type", content_type + "; charset=" + charset)
+    def write(self, data):
+        self.actions.append((ACTION_WRITE, bytes(data)))
+        return len(data)
 
-        if content_encoding:
-            self.send_header("Content-Encoding", content_encoding)
+    def request_served(self):
+        # nothing is sent until AsyncHTTPServer replays the actions, which then calls served()
+        pass
 
-        for h in extra_headers:
-            if ':' in h:
-                self.send_header(h.split(":")[0], h.partition(":")[2])
+    def flush(self):
+        pass
 
-        content = self.file_content(base_path, content_type, content_encoding, charset)
-        if content_encoding == 'gzip':
-            # check if content is already gzipped
-            import magic
-            if magic.from_buffer(content, mime=True) != 'application/x-gzip':
-                import gzip
-                content = gzip.compress(content)
+    def respond_connection_reset(self):
+        self.actions.append((ACTION_RESET, None))
+        self.close_connection = True
+        return False
 
-        if content_mtu == 0:
-            self.end_headers()
-            self.wfile.write(content)
-        else:
-            content = b''.join(self._headers_buffer) + b'\r\n' + content
-            for i in range(math.ceil(len(content)/content_mtu)):
-                self.wfile.write(content[(i*content_mtu):((i + 1) * content_mtu)])
-                pass
+    def delay_response(self, seconds):
+        self.actions.append((ACTION_DELAY, seconds))
 
-    def maybe_serve_index_page(self, dir, path):
-        if os.path.exists(dir + "/_noindex"):
-            self.send_response(404)
-            self.end_headers()
-            return
+    def send_file(self, path, size, offset=0):
+        if size > 0:
+            self.actions.append((ACTION_SENDFILE, (path, offset, size)))
 
-        self.send_response(200)
-        self.send_header("Content-type", "text/html")
-        self.end_headers()
+    def send_stream(self, chunks):
+        self.actions.append((ACTION_STREAM, chunks))
 
-        self.wfile.write('<html>'.encode())
-        self.wfile.write('<head>'.encode())
-        self.wfile.write('<meta charset="UTF-8"/>'.encode())
-        self.wfile.write(('	<title>Contents of %s</title>' % dir).encode())
-        self.wfile.write('</head>'.encode())
-        self.wfile.write('<body>'.encode())
-
-        l = os.listdir(dir)
-        l.sort()
-
-        special_ending = ('.status-code', '.content-type', '.charset', '.content-encoding', '.extra-headers',
-                          '.connection-reset', '.connection-delay', '.content-mtu')
-        special_file = ('README', 'robots.txt', 'default-status-code', 'default-content-type', 'default-charset',
-                        'default-content-encoding', 'default-extra-headers', 'default-connection-delay',
-                        'default-content-mtu')
-        filedir = "" if (path == "/") else path
-        for f in l:
-            if not f.endswith(special_ending) and f not in special_file:
-                self.wfile.write(('<p><a href="%s/%s">%s</a></p>' % (filedir, cgi.escape(f), cgi.escape(f))).encode())
-
-        self.wfile.write('</body>'.encode())
-        self.wfile.write('</html>'.encode())
-
-    def respond_not_found(self, path):
-        self.send_response(404)
-        self.send_header("Content-type", "text/html")
-        self.end_headers()
-        self.wfile.write(('<html><body>404 - %s was not found</body></html>' % path).encode())
+    def send_paced(self, chunks):
+        self.actions.append((ACTION_PACE, chunks))
 
 
 class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
     """Handle requests in a separate thread."""
-    pass
+
+    def __init__(self, server_address, RequestHandlerClass, reuse_port=False):
+        self.reuse_port = reuse_port
+        HTTPServer.__init__(self, server_address, RequestHandlerClass)
+
+    def server_bind(self):
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        HTTPServer.server_bind(self)
+
+    def wrap_ssl(self, ctx):
+        self.socket = ctx.wrap_socket(self.socket, server_side=True, do_handshake_on_connect=False)
+
+
+class TlsStreamProtocol(asyncio.StreamReaderProtocol):
+    """Stream protocol for the asyncio HTTPS listener. It is created when the connection is accepted and
+    connection_made is only called once the handshake is done, which gives the handshake latency."""
+
+    def __init__(self, server):
+        asyncio.StreamReaderProtocol.__init__(self, asyncio.StreamReader(loop=server.loop), server.handle_connection,
+                                              loop=server.loop)
+        self.tls_stats = server.webserver.tls_stats
+        self.accepted = time.perf_counter()
+
+    def connection_made(self, transport):
+        session_reused = transport.get_extra_info('ssl_object').session_reused
+        self.tls_stats.record(time.perf_counter() - self.accepted, session_reused)
+        asyncio.StreamReaderProtocol.connection_made(self, transport)
+
+
+class AsyncHTTPServer:
+    """Handle requests as coroutines on a single event loop, so delayed responses don't hold a thread."""
+
+    request_queue_size = 1024
+
+    def __init__(self, server_address, RequestHandlerClass, reuse_port=False):
+        self.server_address = server_address
+        self.RequestHandlerClass = RequestHandlerClass
+        self.socket = socket.create_server(server_address, backlog=self.request_queue_size, reuse_port=reuse_port)
+        self.server_port = self.socket.getsockname()[1]
+        self.ssl_context = None
+        self.loop = asyncio.new_event_loop()
+        self._stopped = threading.Event()
+
+    def wrap_ssl(self, ctx):
+        self.ssl_context = ctx
+
+    def serve_forever(self):
+        asyncio.set_event_loop(self.loop)
+        if self.ssl_context is None:
+            server = self.loop.run_until_complete(asyncio.start_server(self.handle_connection, sock=self.socket))
+        else:
+            server = self.loop.run_until_complete(
+                self.loop.create_server(self.tls_protocol, sock=self.socket, ssl=self.ssl_context,
+                                        ssl_handshake_timeout=self.webserver.keep_alive_timeout))
+        try:
+            self.loop.run_forever()
+        finally:
+            server.close()
+            tasks = asyncio.all_tasks(self.loop)
+            for task in tasks:
+                task.cancel()
+            self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            self.loop.close()
+            self._stopped.set()
+
+    def shutdown(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._stopped.wait()
+
+    def tls_protocol(self):
+        return TlsStreamProtocol(self)
+
+    async def handle_connection(self, reader, writer):
+        client_address = writer.get_extra_info('peername')
+        # asyncio only sets TCP_NODELAY itself for sockets created with IPPROTO_TCP, which create_server's aren't
+        writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.webserver.metrics.connection_opened()
+        connection_key = tuple(client_address[:2]) + (time.time(),)
+        connection_recorded = False
+        try:
+            close_connection = False
+            requests_handled = 0
+            while not close_connection:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self.webserver.keep_alive_timeout)
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError,
+                        ConnectionError):
+                    break
+
+                try:
+                    handler = self.RequestHandlerClass((head, requests_handled, connection_key), client_address,
+                                                       self)
+                except Exception:
+                    logger.exception("Exception occurred during processing of request from %s", client_address)
+                    break
+
+                connection_recorded = connection_recorded or handler.connection_recorded
+                bytes_sent = 0
+                # a client going away mid response still ends the request, in the ledger and in the metrics
+                try:
+                    for action, value in handler.actions:
+                        if action == ACTION_WRITE:
+                            writer.write(value)
+                            bytes_sent += len(value)
+                            await writer.drain()
+                        elif action == ACTION_DELAY:
+                            await asyncio.sleep(value)
+                        elif action == ACTION_SENDFILE:
+                            path, offset, size = value
+                            with open(path, "rb") as f:
+                                bytes_sent += await self.loop.sendfile(writer.transport, f, offset, size)
+                        elif action == ACTION_STREAM:
+                            for chunk in value:
+                                writer.write(chunk)
+                                bytes_sent += len(chunk)
+                                await writer.drain()
+                        elif action == ACTION_PACE:
+                            # paced bodies wait on the loop, so thousands of slow connections don't need a thread each
+                            deadline = self.loop.time()
+                            for pause, chunk in value:
+                                deadline += pause
+                                if deadline > self.loop.time():
+                                    await asyncio.sleep(deadline - self.loop.time())
+                                writer.write(chunk)
+                                bytes_sent += len(chunk)
+                                await writer.drain()
+                        elif action == ACTION_RESET:
+                            writer.get_extra_info('socket').setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                                                                       struct.pack('ii', 1, 0))
+                            writer.transport.abort()
+                            return
+                finally:
+                    handler.served(bytes_sent)
+                close_connection = handler.close_connection
+                requests_handled = handler.requests_handled
+        except ConnectionError:
+            pass
+        finally:
+            self.webserver.metrics.connection_closed()
+            if connection_recorded:
+                self.webserver.connection_closed(connection_key, time.time())
+            writer.close()
 
 
 class ServerThread(threading.Thread):
-    def __init__(self, server, webserver):
+    def __init__(self, server, webserver, scheme, tenant=None):
         threading.Thread.__init__(self, name="ServerThread")
         self.server = server
         self.server.webserver = webserver
+        self.server.scheme = scheme
+        self.server.tenant = tenant
 
     def run(self):
         self.server.serve_forever()
 
 
+class WorkerProcess:
+    """Forked webserver process and the pipe carrying its ledger records and control calls"""
+
+    def __init__(self, index, process, conn):
+        self.index = index
+        self.process = process
+        self.conn = conn
+        self.lock = threading.Lock()
+
+    def send(self, message):
+        with self.lock:
+            self.conn.send(message)
+
+
 class TestWebServer:
-    def __init__(self, port=8080, sslport=4443, keyfile=None, certfile=None, loggingconf='logging.conf'):
+    def __init__(self, port=8080, sslport=4443, keyfile=None, certfile=None, loggingconf='logging.conf',
+                 body_cache_size=64 * 1024 * 1024, engine=ENGINE_THREADED, keep_alive_timeout=15,
+                 keep_alive_max_requests=100, negotiate_encoding=False, workers=1, certdir=None,
+                 index_page_size=1000, log_queue=False, access_log=None, access_log_sample=1.0, pack=None,
+                 dns_port=None, dns_domain='privacore.test', per_host_ips=False, tenant_ports=None):
         logging.config.fileConfig(loggingconf)
+        # fileConfig disables the loggers that already exist, this module's included
+        logger.disabled = False
+
+        self.access_log = None
+        if access_log is not None:
+            self.access_log = AccessLog(access_log, access_log_sample)
+
+        self.log_queue = log_queue
+        self.log_handlers = list(logging.getLogger().handlers)
+        self.log_listeners = []
+        if log_queue:
+            self.start_log_queues()
 
-        global logger
-        logger = logging.getLogger(__name__)
         logger.info("webserver initializing")
 
         init_mimetypes()
 
         self.http_server_thread = None
         self.https_server_thread = None
-        self.served_urls = []
-
+        self.tenant_server_threads = []
+        # ledger of requests without a tenant, tenants have their own
+        self.served_urls = ServedUrlLedger()
+        self.tenants = {}
+        self.tenants_lock = threading.Lock()
+        # extra HTTP listeners, each serving a tenant
+        self.tenant_ports = dict(tenant_ports or {})
+        for tenant in self.tenant_ports.values():
+            self.tenants[tenant] = ServedUrlLedger()
+        # fixture archive served instead of the test directory
+        self.pack = pack
+        self.fixtures = self.load_fixtures()
+        self.routes = self.fixtures.build_routes()
+        self.per_host_ips = per_host_ips
+        self.host_addresses = self.assign_host_addresses()
+        self.body_cache = BodyCache(body_cache_size)
+        self.index_page_size = index_page_size
+        self.keep_alive_timeout = keep_alive_timeout
+        self.keep_alive_max_requests = keep_alive_max_requests
+        self.negotiate_encoding = negotiate_encoding
+        self.certificates = CertificateStore(certdir)
+        # created before workers are forked, so they share the session ticket keys and resume each other's sessions
+        self.ssl_context = None
         if keyfile is not None and certfile is not None:
-            def servername_callback(ssl_sock, server_name, initial_context):
-                if server_name is None:
-                    return ssl.ALERT_DESCRIPTION_HANDSHAKE_FAILURE
-
-            httpsd = ThreadedHTTPServer(("", sslport), Handler)
-            ctx = ssl.SSLContext(ssl.PROTOCOL_TLSv1)
-            ctx.load_cert_chain(certfile, keyfile)
-            ctx.set_servername_callback(servername_callback)
+            self.ssl_context = create_ssl_context(certfile, keyfile)
+            self.ssl_context.set_servername_callback(self.servername_callback)
+        self.tls_stats = TlsStats()
+        self.metrics = ServerMetrics()
+
+        # set in worker processes, where ledger records are forwarded to the parent
+        self.parent_conn = None
+        self.parent_conn_lock = None
+        self.record_keys = None
+
+        # calls waiting for an answer, from the workers in the parent or from the parent in a worker
+        self.pending_calls = {}
+        self.call_ids = itertools.count()
+
+        self.dns_server = None
+        self.workers = []
+        if workers > 1:
+            self.start_workers(workers, port, sslport, engine)
+        else:
+            self.start_servers(port, sslport, engine)
+
+        # answered by this process only, after the workers are forked
+        if dns_port is not None:
+            self.dns_server = dnsserver.DnsServer(('127.0.0.1', dns_port), dns_domain, self.resolve_host)
+            self.dns_server.start()
+            logger.info("dns server answering %s on port %d", dns_domain, dns_port)
+
+        logger.info("webserver initialized (%s engine, %d workers)", engine, workers)
+
+    def start_log_queues(self):
+        """Write log records from background threads, so file I/O and rotation stay off the request path"""
+        root = logging.getLogger()
+        self.log_listeners = [(root, start_log_queue(root, self.log_handlers))]
+        if self.access_log is not None:
+            access_logger = self.access_log.logger
+            self.log_listeners.append((access_logger, start_log_queue(access_logger, [self.access_log.handler])))
+
+    def stop_log_queues(self):
+        for log, listener in self.log_listeners:
+            stop_log_queue(log, listener)
+        self.log_listeners = []
+
+    def servername_callback(self, ssl_sock, server_name, initial_context):
+        if server_name is None:
+            return ssl.ALERT_DESCRIPTION_HANDSHAKE_FAILURE
+
+        testset_ctx = self.certificates.context_for(server_name)
+        if testset_ctx is not None:
+            ssl_sock.context = testset_ctx
+
+    def start_servers(self, port, sslport, engine, reuse_port=False):
+        if engine == ENGINE_ASYNCIO:
+            server_class, handler_class = AsyncHTTPServer, AsyncHandler
+        else:
+            server_class, handler_class = ThreadedHTTPServer, Handler
 
-            httpsd.socket = ctx.wrap_socket(httpsd.socket, server_side=True)
-            self.https_server_thread = ServerThread(httpsd, self)
+        if self.ssl_context is not None:
+            httpsd = server_class(("", sslport), handler_class, reuse_port)
+            httpsd.wrap_ssl(self.ssl_context)
+            self.https_server_thread = ServerThread(httpsd, self, "https")
             self.https_server_thread.daemon = True
             self.https_server_thread.start()
 
-        httpd = ThreadedHTTPServer(("", port), Handler)
-        self.http_server_thread = ServerThread(httpd, self)
+        httpd = server_class(("", port), handler_class, reuse_port)
+        self.http_server_thread = ServerThread(httpd, self, "http")
         self.http_server_thread.daemon = True
         self.http_server_thread.start()
 
-        logger.info("webserver initialized")
+        for tenant_port, tenant in self.tenant_ports.items():
+            tenantd = server_class(("", tenant_port), handler_class, reuse_port)
+            server_thread = ServerThread(tenantd, self, "http", tenant)
+            server_thread.daemon = True
+            server_thread.start()
+            self.tenant_server_threads.append(server_thread)
+
+    def start_workers(self, workers, port, sslport, engine):
+        self.worker_records = {}
+
+        context = multiprocessing.get_context('fork')
+        for index in range(workers):
+            parent_conn, child_conn = context.Pipe()
+            process = context.Process(target=self.run_worker, name="WebServerWorker-%d" % index,
+                                      args=(child_conn, port, sslport, engine))
+            process.daemon = True
+            process.start()
+            child_conn.close()
+            self.workers.append(WorkerProcess(index, process, parent_conn))
+
+        self.wait_workers_ready()
+
+        self.worker_collector_thread = threading.Thread(target=self.collect_worker_messages,
+                                                        name="WorkerCollectorThread")
+        self.worker_collector_thread.daemon = True
+        self.worker_collector_thread.start()
+
+    def wait_workers_ready(self):
+        """Wait for every worker to report its listeners started, raising the error of a worker that failed to
+        start them like start_servers does without workers"""
+        error = None
+        for worker in self.workers:
+            try:
+                message = worker.conn.recv()
+                while message[0] == 'log':
+                    self.handle_worker_log(message[1])
+                    message = worker.conn.recv()
+            except EOFError:
+                message = ('error', RuntimeError("webserver worker %d exited while starting" % worker.index))
+            if message[0] == 'error' and error is None:
+                error = message[1]
+
+        if error is not None:
+            for worker in self.workers:
+                worker.process.terminate()
+                worker.process.join(5)
+                worker.conn.close()
+            self.workers = []
+            raise error
+
+    def run_worker(self, conn, port, sslport, engine):
+        # drop the pipes of workers forked before this one
+        for worker in self.workers:
+            worker.conn.close()
+        self.workers = []
+
+        self.parent_conn = conn
+        # reentrant, as starting the servers logs while holding it
+        self.parent_conn_lock = threading.RLock()
+        self.record_keys = itertools.count()
+        # log through the parent instead of the file handlers inherited from it
+        root = logging.getLogger()
+        for handler in root.handlers[:]:
+            root.removeHandler(handler)
+        self.log_handlers = [ParentLogHandler(self)]
+        # the listener threads of the parent don't exist in the fork
+        if self.log_queue:
+            self.start_log_queues()
+        else:
+            root.addHandler(self.log_handlers[0])
+
+        # held until the parent is told, so a request's records can't get ahead of it
+        with self.parent_conn_lock:
+            try:
+                self.start_servers(port, sslport, engine, reuse_port=True)
+            except Exception as e:
+                conn.send(('error', e))
+                return
+            conn.send(('ready',))
+
+        while True:
+            try:
+                message = conn.recv()
+            except EOFError:
+                break
+
+            if message[0] == 'result':
+                self.set_call_result(*message[1:])
+                continue
+
+            call_id, name, args = message[1:]
+            result = getattr(self, name)(*args) if name is not None else None
+            self.send_to_parent(('result', call_id, result))
+            if name == 'stop':
+                break
+
+    def send_to_parent(self, message):
+        with self.parent_conn_lock:
+            self.parent_conn.send(message)
+
+    def collect_worker_messages(self):
+        conns = {worker.conn: worker for worker in self.workers}
+        while conns:
+            for conn in multiprocessing.connection.wait(list(conns)):
+                try:
+                    message = conn.recv()
+                except EOFError:
+                    del conns[conn]
+                    continue
+
+                worker = conns[conn]
+                if message[0] == 'begin':
+                    key, url, client_address, timestamp, tenant, connection = message[1:]
+                    self.worker_records[(worker.index, key)] = (
+                        tenant, self.ledger(tenant).begin(url, client_address, timestamp, connection))
+                elif message[0] == 'finish':
+                    key, status, bytes_sent, latency, bytes_saved = message[1:]
+                    record_id = self.worker_records.pop((worker.index, key), None)
+                    if record_id is not None:
+                        self.finish_served_url(record_id, status, bytes_sent, latency, bytes_saved)
+                elif message[0] == 'closed':
+                    self.connection_closed(*message[1:])
+                elif message[0] == 'log':
+                    self.handle_worker_log(message[1])
+                elif message[0] == 'result':
+                    self.set_call_result(*message[1:])
+                elif message[0] == 'call':
+                    # answered on its own thread, as the call may itself wait for results collected here
+                    threading.Thread(target=self.answer_worker_call, args=(worker,) + message[1:],
+                                     name="WorkerCallThread", daemon=True).start()
+
+    def handle_worker_log(self, record):
+        logging.getLogger(record.name).handle(record)
+
+    def answer_worker_call(self, worker, call_id, name, args):
+        worker.send(('result', call_id, getattr(self, name)(*args)))
+
+    def new_call(self):
+        call_id = next(self.call_ids)
+        call = [threading.Event(), None]
+        self.pending_calls[call_id] = call
+        return call_id, call
+
+    def set_call_result(self, call_id, result):
+        call = self.pending_calls.get(call_id)
+        if call is not None:
+            call[1] = result
+            call[0].set()
+
+    def call_workers(self, name, *args, timeout=10):
+        """Call a TestWebServer method in every worker and return their results.
+
+        Replies travel the same pipe as ledger records, so every record sent before the call has been collected
+        by the time it returns. name None just waits for that."""
+        calls = []
+        for worker in self.workers:
+            if not worker.process.is_alive():
+                continue
+
+            call_id, call = self.new_call()
+            worker.send(('call', call_id, name, args))
+            calls.append((call_id, call))
+
+        results = []
+        for call_id, call in calls:
+            if call[0].wait(timeout):
+                results.append(call[1])
+            else:
+                logger.warning("webserver worker didn't answer %s", name)
+            del self.pending_calls[call_id]
+
+        return results
+
+    def call_parent(self, name, *args, timeout=10):
+        """Call a TestWebServer method in the parent of this worker and return its result"""
+        call_id, call = self.new_call()
+        self.send_to_parent(('call', call_id, name, args))
+        try:
+            if not call[0].wait(timeout):
+                logger.warning("webserver parent didn't answer %s", name)
+            return call[1]
+        finally:
+            del self.pending_calls[call_id]
+
+    def call_control(self, name, *args):
+        """Call a TestWebServer method where the ledgers are, in the parent when this is a worker"""
+        if self.parent_conn is not None:
+            return self.call_parent(name, *args)
+        return getattr(self, name)(*args)
 
     def stop(self):
         logger.info("webserver stopping")
 
+        if self.workers:
+            self.call_workers('stop')
+            for worker in self.workers:
+                worker.process.join(5)
+
         if self.http_server_thread:
             self.http_server_thread.server.shutdown()
 
         if self.https_server_thread:
             self.https_server_thread.server.shutdown()
 
+        for server_thread in self.tenant_server_threads:
+            server_thread.server.shutdown()
+
+        if self.dns_server is not None:
+            self.dns_server.shutdown()
+
         logger.info("webserver stopped")
+        self.stop_log_queues()
+        if self.access_log is not None:
+            self.access_log.close()
+
+    def load_fixtures(self):
+        if self.pack is not None:
+            return PackedFixtures(self.pack)
+        return FixtureFiles(root_dir)
+
+    def reload_routes(self):
+        """Rebuild the route table, picking up fixtures changed on disk or a rebuilt archive"""
+        self.fixtures = self.load_fixtures()
+        self.routes = self.fixtures.build_routes()
+        self.host_addresses = self.assign_host_addresses()
+        self.call_workers('reload_routes')
+        logger.info("webserver loaded %d routes", len(self.routes))
+
+    def assign_host_addresses(self):
+        """Map every (testset, server) to its own loopback address when per_host_ips is set, so a crawler's per
+        IP politeness treats them as separate origins. Addresses follow the sorted host names, so they are
+        stable for a given test tree"""
+        if not self.per_host_ips:
+            return {}
+
+        servers = sorted(self.routes.servers())
+        if LOOPBACK_BASE + len(servers) > LOOPBACK_LAST:
+            raise ValueError('too many test hosts for distinct loopback addresses: %d' % len(servers))
+        return {server: str(LOOPBACK_BASE + i) for i, server in enumerate(servers)}
+
+    def host_address(self, testset, server):
+        return self.host_addresses.get((testset, server), '127.0.0.1')
+
+    def resolve_host(self, labels):
+        """Address of <server>.<testset> or <server>.<testset>.<tenant> in the DNS zone, None for unknown hosts"""
+        if len(labels) == 3 and labels[2] in self.tenants:
+            labels = labels[:2]
+        if len(labels) != 2:
+            return None
+        server, testset = labels
+        if not self.routes.has_server(testset, server):
+            return None
+        return self.host_address(testset, server)
+
+    def get_body_cache_stats(self):
+        if not self.workers:
+            return self.body_cache.stats()
+
+        stats = collections.Counter()
+        for worker_stats in self.call_workers('get_body_cache_stats'):
+            stats.update(worker_stats)
+        return dict(stats)
+
+    def get_tls_stats(self):
+        if not self.workers:
+            stats = self.tls_stats.stats()
+        else:
+            stats = collections.Counter()
+            max_handshake_time = 0.0
+            for worker_stats in self.call_workers('get_tls_stats'):
+                max_handshake_time = max(max_handshake_time, worker_stats.pop('max_handshake_time'))
+                for name in ('resumption_rate', 'avg_handshake_time'):
+                    worker_stats.pop(name)
+                stats.update(worker_stats)
+            stats = dict(stats, max_handshake_time=max_handshake_time)
+
+        handshakes = stats.get('handshakes', 0)
+        stats['resumption_rate'] = stats.get('resumed', 0) / handshakes if handshakes else 0.0
+        stats['avg_handshake_time'] = stats.get('handshake_time', 0.0) / handshakes if handshakes else 0.0
+        return stats
+
+    def get_metrics(self):
+        return self.metrics.stats()
+
+    def get_stats(self):
+        """Live counters served at /_stats, combined over all worker processes"""
+        if self.parent_conn is not None:
+            return self.call_parent('get_stats')
+
+        if self.workers:
+            stats = merge_metrics(self.call_workers('get_metrics'))
+        else:
+            stats = self.metrics.stats()
+        stats['latency_buckets'] = list(LATENCY_BUCKETS)
+
+        body_cache = self.get_body_cache_stats()
+        lookups = body_cache['hits'] + body_cache['misses']
+        body_cache['hit_rate'] = body_cache['hits'] / lookups if lookups else 0.0
+        stats['body_cache'] = body_cache
+        stats['tls'] = self.get_tls_stats()
+        if self.dns_server is not None:
+            stats['dns'] = self.dns_server.stats()
+        return stats
+
+    def ledger(self, tenant=None):
+        if tenant is None:
+            return self.served_urls
+        return self.tenants[tenant]
+
+    def register_tenant(self, tenant):
+        """Give tenant its own ledger, from now on requests for <server>.<testset>.<tenant>.<domain> are
+        recorded there"""
+        with self.tenants_lock:
+            if tenant not in self.tenants:
+                self.tenants[tenant] = ServedUrlLedger()
+        self.call_workers('register_tenant', tenant)
+
+    def tenant_stats(self):
+        return {tenant: {'served_urls': len(ledger)} for tenant, ledger in list(self.tenants.items())}
+
+    def add_served_url(self, url, client_address=None, tenant=None, connection=None):
+        if self.parent_conn is None:
+            return tenant, self.ledger(tenant).begin(url, client_address, connection=connection)
+
+        key = next(self.record_keys)
+        self.send_to_parent(('begin', key, url, client_address, time.time(), tenant, connection))
+        return key
+
+    def finish_served_url(self, record_id, status, bytes_sent, latency, bytes_saved=0):
+        if self.parent_conn is None:
+            tenant, record_id = record_id
+            self.ledger(tenant).finish(record_id, status, bytes_sent, latency, bytes_saved)
+        else:
+            self.send_to_parent(('finish', record_id, status, bytes_sent, latency, bytes_saved))
+
+    def connection_closed(self, connection, timestamp):
+        if self.parent_conn is not None:
+            return self.send_to_parent(('closed', connection, timestamp))
+
+        # a kept alive connection may have carried requests of several tenants
+        self.served_urls.connection_closed(connection, timestamp)
+        for ledger in list(self.tenants.values()):
+            ledger.connection_closed(connection, timestamp)
+
+    def get_served_urls(self, tenant=None):
+        self.call_workers(None)
+        return self.ledger(tenant).snapshot()
+
+    def clear_served_urls(self, tenant=None):
+        """Clear the ledger of tenant, registering it if it is new"""
+        if tenant is not None:
+            self.register_tenant(tenant)
+        self.call_workers(None)
+        self.ledger(tenant).clear()
+
+    def served_records(self, tenant):
+        """Records of the ledger of tenant as JSON-able dicts, None for an unknown tenant"""
+        if tenant not in self.tenants:
+            return None
+        return [record._asdict() for record in self.get_served_urls(tenant).records()]
+
+
+class WebServerClient:
+    """Stand-in for TestWebServer in a runner that shares a long-lived webserver (host:port) with others.
+    The runner is tenant there and reaches its ledger through the control API"""
+
+    def __init__(self, address, tenant, timeout=60):
+        host, _, port = address.rpartition(':')
+        self.host = host or '127.0.0.1'
+        self.port = int(port)
+        self.tenant = tenant
+        self.timeout = timeout
+
+    def control(self, path):
+        conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        try:
+            conn.request('GET', path, headers={'Host': 'control'})
+            response = conn.getresponse()
+            content = response.read()
+        finally:
+            conn.close()
+
+        if response.status != 200:
+            raise RuntimeError('webserver control request %s failed with status %d' % (path, response.status))
+        return json.loads(content)
 
-    def add_served_url(self, url):
-        self.served_urls.append(url)
+    def reload_routes(self):
+        self.control('/_reload')
 
     def get_served_urls(self):
-        return self.served_urls
+        served_urls = ServedUrlLedger()
+        for record in self.control('/_tenants/%s/served_urls' % self.tenant):
+            connection = record['connection']
+            served_urls.add(record['url'], record['client_address'], record['timestamp'], record['status'],
+                            record['bytes_sent'], record['latency'], record['bytes_saved'],
+                            tuple(connection) if connection is not None else None, record['connection_closed'])
+        return served_urls
 
     def clear_served_urls(self):
-        self.served_urls = []
+        self.control('/_tenants/%s/clear' % self.tenant)
+
+    def stop(self):
+        # the shared webserver outlives its runners
+        pass
+
+
+def parse_tenant_port(value):
+    port, _, tenant = value.partition('=')
+    if not tenant:
+        raise argparse.ArgumentTypeError('expected <port>=<tenant>: %s' % value)
+    return int(port), tenant
 
 
 if __name__ == '__main__':
@@ -367,9 +2920,45 @@ if __name__ == '__main__':
     parser.add_argument("--keyfile", type=str, help="SSL key file (.key)")
     parser.add_argument("--certfile", type=str, help="SSL certificate file (.cert)")
     parser.add_argument("--loggingconf", type=str, default="logging.conf")
+    parser.add_argument("--body-cache-size", type=int, help="Rendered body cache size in bytes",
+                        default=64 * 1024 * 1024)
+    parser.add_argument("--engine", choices=[ENGINE_THREADED, ENGINE_ASYNCIO], default=ENGINE_THREADED,
+                        help="Serving engine (default: threaded)")
+    parser.add_argument("--keep-alive-timeout", type=float, default=15,
+                        help="Seconds an idle keep-alive connection is kept open (default: 15)")
+    parser.add_argument("--keep-alive-max-requests", type=int, default=100,
+                        help="Requests served on a connection before it is closed (default: 100)")
+    parser.add_argument("--negotiate-encoding", action="store_true",
+                        help="Compress text responses according to the client's Accept-Encoding")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of processes sharing the ports through SO_REUSEPORT (default: 1)")
+    parser.add_argument("--certdir", type=str,
+                        help="Directory with per testset certificates (<testset>.cert and <testset>.key)")
+    parser.add_argument("--index-page-size", type=int, default=1000,
+                        help="Entries per index page when a listing is requested with ?page=")
+    parser.add_argument("--log-queue", action="store_true",
+                        help="Write log records from a background thread instead of the request threads")
+    parser.add_argument("--access-log", type=str, help="Write a JSONL access log to this file")
+    parser.add_argument("--access-log-sample", type=float, default=1.0,
+                        help="Share of requests written to the access log (default: 1.0)")
+    parser.add_argument("--pack", type=str,
+                        help="Serve fixtures from an archive built by fixturepack.py instead of the test directory")
+    parser.add_argument("--dns-port", type=int,
+                        help="Answer DNS queries for the test hosts on this UDP port of 127.0.0.1")
+    parser.add_argument("--dns-domain", type=str, default="privacore.test",
+                        help="Domain the test hosts are under (default: privacore.test)")
+    parser.add_argument("--per-host-ips", action="store_true",
+                        help="Resolve every test host to its own 127.x.y.z address")
+    parser.add_argument("--tenant-port", type=parse_tenant_port, action="append", default=[],
+                        help="Extra HTTP port whose requests are recorded for a tenant, as <port>=<tenant>")
     args = parser.parse_args()
 
-    test_webserver = TestWebServer(args.port, args.sslport, args.keyfile, args.certfile, args.loggingconf)
+    test_webserver = TestWebServer(args.port, args.sslport, args.keyfile, args.certfile, args.loggingconf,
+                                   args.body_cache_size, args.engine, args.keep_alive_timeout,
+                                   args.keep_alive_max_requests, args.negotiate_encoding, args.workers,
+                                   args.certdir, args.index_page_size, args.log_queue, args.access_log,
+                                   args.access_log_sample, args.pack, args.dns_port, args.dns_domain,
+                                   args.per_host_ips, dict(args.tenant_port))
 
     time.sleep(10 * 356 * 84100)
 